@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""
+	Created by:	Shaheen Syed
+	Date:		August 2018
+
+	Binary corpus format as an alternative to the MatrixMarket format of gensim. A MatrixMarket corpus (corpus.mm) is a text file that is parsed again
+	every time it is read, which adds up when dozens of models are trained on the same corpus. The binary corpus stores the bag-of-words of all documents
+	in compressed sparse row (CSR) form, as three numpy arrays in a folder:
+
+		indptr.npy		(int64)		the bag-of-words of document i is stored at positions indptr[i] up to indptr[i+1]
+		indices.npy		(int32)		token id of each position
+		counts.npy		(int32)		frequency of the token within the document
+
+	The arrays are opened memory-mapped, so loading the corpus does not read or copy any data, and processes that train models on the same corpus at the
+	same time share the pages in the page cache of the operating system. The BinaryCorpus can be used wherever gensim expects a streamed corpus:
+
+		BinaryCorpus.serialize(os.path.join('files', 'lda', 'corpus.csr'), corpus)
+		corpus = BinaryCorpus(os.path.join('files', 'lda', 'corpus.csr'))
+		model = models.LdaModel(corpus, ...)
+
+	New documents can be appended in place (BinaryCorpus.append), without rewriting the documents that are already in the corpus.
+"""
+
+# packages and modules
+import logging, sys, os, shutil
+from io import BytesIO
+import numpy as np
+
+
+class BinaryCorpus():
+
+	def __init__(self, folder):
+
+		"""
+			Open a binary corpus memory-mapped
+
+			Parameters
+			----------
+			folder : os.path
+				location of the binary corpus (see serialize)
+		"""
+
+		self.folder = folder
+
+		self.indptr = np.load(os.path.join(folder, 'indptr.npy'), mmap_mode = 'r')
+		self.indices = np.load(os.path.join(folder, 'indices.npy'), mmap_mode = 'r')
+		self.counts = np.load(os.path.join(folder, 'counts.npy'), mmap_mode = 'r')
+
+	def __len__(self):
+
+		return len(self.indptr) - 1
+
+	def __getitem__(self, i):
+
+		"""
+			Return the bag-of-words of document i as a list of (token id, frequency) tuples
+		"""
+
+		start, end = self.indptr[i], self.indptr[i + 1]
+
+		return zip(self.indices[start:end].tolist(), self.counts[start:end].tolist())
+
+	def __iter__(self):
+
+		for i in xrange(len(self)):
+			yield self[i]
+
+	@staticmethod
+	def serialize(folder, corpus, buffer_size = 1000000):
+
+		"""
+			Write a corpus in binary form. The corpus is streamed: the token ids and frequencies are written to raw files in blocks of buffer_size positions,
+			which are copied into the numpy files once the total number of positions is known
+
+			Parameters
+			----------
+			folder : os.path
+				location to save the binary corpus to; an existing binary corpus in this location is replaced
+			corpus : iterable
+				bag-of-words of each document, e.g. a list or generator of lists of (token id, frequency) tuples
+			buffer_size : int (optional)
+				number of positions that are kept in memory before they are written
+		"""
+
+		# write to a temporary folder first, so a failed run does not leave a broken corpus
+		tmp_folder = folder + '.tmp'
+		if os.path.exists(tmp_folder):
+			shutil.rmtree(tmp_folder)
+		os.makedirs(tmp_folder)
+
+		indptr, indices, counts = [0], [], []
+
+		with open(os.path.join(tmp_folder, 'indices.raw'), 'wb') as f_indices, open(os.path.join(tmp_folder, 'counts.raw'), 'wb') as f_counts:
+
+			for bow in corpus:
+
+				for token_id, count in bow:
+					indices.append(token_id)
+					counts.append(count)
+
+				indptr.append(indptr[-1] + len(bow))
+
+				# write the buffered positions
+				if len(indices) >= buffer_size:
+					np.array(indices, dtype = '<i4').tofile(f_indices)
+					np.array(counts, dtype = '<i4').tofile(f_counts)
+					indices, counts = [], []
+
+			np.array(indices, dtype = '<i4').tofile(f_indices)
+			np.array(counts, dtype = '<i4').tofile(f_counts)
+
+		np.save(os.path.join(tmp_folder, 'indptr.npy'), np.array(indptr, dtype = '<i8'))
+
+		# copy the raw files into numpy files in blocks
+		for name in ['indices', 'counts']:
+
+			raw_file = os.path.join(tmp_folder, name + '.raw')
+			raw = np.memmap(raw_file, dtype = '<i4', mode = 'r') if indptr[-1] > 0 else np.zeros(0, dtype = '<i4')
+
+			array = np.lib.format.open_memmap(os.path.join(tmp_folder, name + '.npy'), mode = 'w+', dtype = '<i4', shape = (indptr[-1],))
+			for start in xrange(0, indptr[-1], buffer_size):
+				array[start:start + buffer_size] = raw[start:start + buffer_size]
+			array.flush()
+
+			del array, raw
+			os.remove(raw_file)
+
+		# replace the existing binary corpus
+		if os.path.exists(folder):
+			shutil.rmtree(folder)
+		os.rename(tmp_folder, folder)
+
+		logging.info('Saved binary corpus with {} documents and {} positions to {}'.format(len(indptr) - 1, indptr[-1], folder))
+
+	@staticmethod
+	def append(folder, corpus, buffer_size = 1000000):
+
+		"""
+			Append documents to the end of a binary corpus in place. The token ids and frequencies are appended to indices.npy and counts.npy, and 
+			indptr.npy is extended last, so an interrupted append leaves the corpus as it was: positions beyond the last entry of indptr are not part 
+			of the corpus, and are overwritten by the next append
+
+			Parameters
+			----------
+			folder : os.path
+				location of the binary corpus
+			corpus : iterable
+				bag-of-words of each new document
+			buffer_size : int (optional)
+				number of positions that are kept in memory before they are written
+		"""
+
+		indptr = np.load(os.path.join(folder, 'indptr.npy')).tolist()
+		num_docs, start = len(indptr) - 1, indptr[-1]
+
+		# open the arrays at the end of the positions of the corpus
+		files = [open_npy_at(os.path.join(folder, name + '.npy'), start) for name in ['indices', 'counts']]
+
+		indices, counts = [], []
+		for bow in corpus:
+
+			for token_id, count in bow:
+				indices.append(token_id)
+				counts.append(count)
+
+			indptr.append(indptr[-1] + len(bow))
+
+			# write the buffered positions
+			if len(indices) >= buffer_size:
+				np.array(indices, dtype = '<i4').tofile(files[0])
+				np.array(counts, dtype = '<i4').tofile(files[1])
+				indices, counts = [], []
+
+		np.array(indices, dtype = '<i4').tofile(files[0])
+		np.array(counts, dtype = '<i4').tofile(files[1])
+
+		for f in files:
+			f.close()
+
+		# update the length of the arrays; indptr last, since it determines which positions belong to the corpus
+		for name in ['indices', 'counts']:
+			set_npy_length(os.path.join(folder, name + '.npy'), indptr[-1])
+		with open_npy_at(os.path.join(folder, 'indptr.npy'), num_docs + 1) as f:
+			np.array(indptr[num_docs + 1:], dtype = '<i8').tofile(f)
+		set_npy_length(os.path.join(folder, 'indptr.npy'), len(indptr))
+
+		logging.info('Appended {} documents and {} positions to binary corpus {}'.format(len(indptr) - 1 - num_docs, indptr[-1] - start, folder))
+
+
+"""
+
+internal helper functions
+
+"""
+
+def read_npy_header(f):
+
+	"""
+		Read the header of an open numpy file; returns the format version, the dtype and the offset of the data
+	"""
+
+	version = np.lib.format.read_magic(f)
+	if version == (1, 0):
+		_, _, dtype = np.lib.format.read_array_header_1_0(f)
+	else:
+		_, _, dtype = np.lib.format.read_array_header_2_0(f)
+
+	return version, dtype, f.tell()
+
+def open_npy_at(file_name, length):
+
+	"""
+		Open a one-dimensional numpy file for writing after its first length items; the items after them are removed
+	"""
+
+	f = open(file_name, 'r+b')
+	_, dtype, offset = read_npy_header(f)
+
+	f.seek(offset + length * dtype.itemsize)
+	f.truncate()
+
+	return f
+
+def set_npy_length(file_name, length):
+
+	"""
+		Set the length in the header of a one-dimensional numpy file, after items were written to or removed from the end of its data. The header is 
+		padded, so the new header normally fits in place; otherwise the data is copied to a new file
+	"""
+
+	with open(file_name, 'r+b') as f:
+
+		version, dtype, offset = read_npy_header(f)
+
+		header = BytesIO()
+		write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+		write_header(header, {'descr' : np.lib.format.dtype_to_descr(dtype), 'fortran_order' : False, 'shape' : (length,)})
+
+		if len(header.getvalue()) == offset:
+			f.seek(0)
+			f.write(header.getvalue())
+			return
+
+	# copy the data behind a header of a different size
+	data = np.memmap(file_name, dtype = dtype, mode = 'r', offset = offset, shape = (length,)) if length > 0 else np.zeros(0, dtype = dtype)
+	array = np.lib.format.open_memmap(file_name + '.tmp', mode = 'w+', dtype = dtype, shape = (length,))
+	for start in xrange(0, length, 1000000):
+		array[start:start + 1000000] = data[start:start + 1000000]
+	array.flush()
+
+	del array, data
+	os.rename(file_name + '.tmp', file_name)
@@ -8,8 +8,11 @@
 """
 
 # packages and modules
-from pymongo import MongoClient
-import time, logging, sys
+from pymongo import MongoClient, UpdateOne, ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+import time, logging, sys, os, sqlite3, threading, socket, uuid
+from datetime import datetime, timedelta
+from collections import Counter
 from bson.objectid import ObjectId
 
 
@@ -21,14 +24,14 @@ class MongoDatabase:
 		self.db = self.client[client]
 
 
-	def read_collection(self, collection):
+	def read_collection(self, collection, query = None, projection = None):
 
 		"""
-			Read all documents in a certain collection
+			Read all documents in a certain collection, optionally only the documents that match a query and only the fields of a projection
 		"""
 
 		try:
-			return self.db[collection].find({}, no_cursor_timeout=True)
+			return self.db[collection].find(query or {}, projection, no_cursor_timeout=True)
 		except Exception, e:
 			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
 			exit(1)
@@ -47,6 +50,160 @@ class MongoDatabase:
 			exit(1)
 
 
+	def insert_many_to_collection(self, collection, docs, ignore_duplicates = False):
+
+
+		"""
+			Insert a batch of documents to a collection in one round trip. With ignore_duplicates, documents that violate a unique index 
+			are skipped (insert-or-ignore) while the other documents are still inserted. Returns the number of inserted documents
+		"""
+
+		try:
+			if len(docs) > 0:
+				return len(self.db[collection].insert_many(docs, ordered = False).inserted_ids)
+			return 0
+		except BulkWriteError, e:
+			# 11000 is the duplicate key error code
+			errors = [x for x in e.details['writeErrors'] if not (ignore_duplicates and x['code'] == 11000)]
+			if len(errors) > 0:
+				logging.error("[{}] : {}".format(sys._getframe().f_code.co_name, errors[0]['errmsg']))
+				exit(1)
+			logging.debug('Skipped {} duplicate documents'.format(len(e.details['writeErrors'])))
+			return e.details['nInserted']
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def create_unique_index(self, collection, keys):
+
+
+		"""
+			Create a unique (compound) index on the keys of a collection, if it does not exist yet. Returns False if the index could not be 
+			created, for instance because the collection already contains duplicates
+		"""
+
+		try:
+			self.db[collection].create_index([(key, ASCENDING) for key in keys], unique = True)
+			return True
+		except Exception, e:
+			logging.warning("[{}] : unique index on {} not created: {}".format(sys._getframe().f_code.co_name, keys, e))
+			return False
+
+
+	def create_index(self, collection, keys):
+
+
+		"""
+			Create a (compound) index on the keys of a collection, if it does not exist yet
+		"""
+
+		try:
+			self.db[collection].create_index([(key, ASCENDING) for key in keys])
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def update_fields_in_collection(self, collection, updates, sequence_field = None):
+
+
+		"""
+			Set fields of a batch of documents in one round trip (unordered bulk write), without replacing the full documents
+
+			Parameters
+			----------
+			collection : string
+				name of the collection
+			updates : list of tuples
+				_id of the document and a dictionary with the fields and values to set
+			sequence_field : string (optional)
+				field that records the sequence number of the first batch in which a document was updated (see next_sequence), so documents 
+				that were first updated after a certain point can be found with a range query
+		"""
+
+		try:
+			if len(updates) > 0:
+				# $min keeps the sequence number of the first update of a document
+				sequence = self.next_sequence('{}.{}'.format(collection, sequence_field)) if sequence_field is not None else None
+				self.db[collection].bulk_write([UpdateOne({'_id' : ObjectId(doc_id)}, {'$set' : fields, '$min' : {sequence_field : sequence}} if sequence is not None 
+												else {'$set' : fields}) for doc_id, fields in updates], ordered = False)
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def update_many_in_collection(self, collection, query, fields):
+
+
+		"""
+			Set fields of all documents that match a query, in one round trip
+		"""
+
+		try:
+			self.db[collection].update_many(query, {'$set' : fields})
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def next_sequence(self, name):
+
+
+		"""
+			Return the next number of a sequence. The number is incremented by the server, so the numbers increase in the order they are handed out,
+			unlike ObjectIds, which are created by the clients
+		"""
+
+		try:
+			return self.db['counters'].find_one_and_update({'_id' : name}, {'$inc' : {'seq' : 1}}, upsert = True, return_document = ReturnDocument.AFTER)['seq']
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def get_sequence(self, name):
+
+
+		"""
+			Return the last number handed out by a sequence, or 0 if the sequence has not been used yet
+		"""
+
+		try:
+			counter = self.db['counters'].find_one({'_id' : name})
+			return counter['seq'] if counter is not None else 0
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def replace_fields_in_collection(self, collection, updates, set_field, unset_field):
+
+
+		"""
+			Replace a field of a batch of documents by another field in one round trip (unordered bulk write)
+
+			Parameters
+			----------
+			collection : string
+				name of the collection
+			updates : list of tuples
+				_id of the document and the value of set_field
+			set_field : string
+				name of the field to set
+			unset_field : string
+				name of the field to remove
+		"""
+
+		try:
+			if len(updates) > 0:
+				self.db[collection].bulk_write([UpdateOne({'_id' : ObjectId(doc_id)}, {'$set' : {set_field : value}, '$unset' : {unset_field : ''}}) 
+												for doc_id, value in updates], ordered = False)
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
 	def update_collection(self, collection, doc):
 
 
@@ -61,3 +218,460 @@ class MongoDatabase:
 		except Exception, e:
 			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
 			exit(1)
+
+
+class CrawlManifest:
+
+	"""
+		Local SQLite store that keeps track of every publication discovered by the crawler: its url, download status, size, md5 and the time
+		of the last update. Skip decisions are a single set lookup and publications that failed to download can be picked up again.
+		Thread-safe, so one manifest can be shared by all crawler threads.
+	"""
+
+	def __init__(self, manifest_file = os.path.join('files', 'pdf', 'manifest.db')):
+
+		# create folder of the manifest if not exists
+		folder = os.path.dirname(manifest_file)
+		if folder and not os.path.exists(folder):
+			os.makedirs(folder)
+
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(manifest_file, check_same_thread = False)
+		self.connection.execute("""CREATE TABLE IF NOT EXISTS manifest (
+										journal TEXT, year TEXT, name TEXT, url TEXT, pdf_url TEXT, folder TEXT, 
+										status TEXT, size INTEGER, md5 TEXT, timestamp TEXT, 
+										PRIMARY KEY (journal, year, name))""")
+		self.connection.execute('CREATE INDEX IF NOT EXISTS manifest_status ON manifest (status)')
+		self.connection.commit()
+
+
+	def has_year(self, journal, year):
+
+		"""
+			Check if the manifest contains any publication of a journal and year
+		"""
+
+		with self.lock:
+			return self.connection.execute('SELECT 1 FROM manifest WHERE journal = ? AND year = ? LIMIT 1', (journal, year)).fetchone() is not None
+
+
+	def import_directory(self, journal, year, folder):
+
+		"""
+			Register PDFs that are already on disk (e.g. downloaded before the manifest existed) as downloaded. Only done once per journal and year,
+			afterwards the folder is never read again
+		"""
+
+		if self.has_year(journal, year) or not os.path.exists(folder):
+			return
+
+		rows = []
+		for file_name in os.listdir(folder):
+			if file_name.endswith('.pdf'):
+				path = os.path.join(folder, file_name)
+				rows.append((journal, year, file_name[0:-4], None, None, folder, 'downloaded', os.path.getsize(path), None, datetime.now().isoformat()))
+
+		with self.lock:
+			self.connection.executemany('INSERT OR IGNORE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			self.connection.commit()
+
+		logging.info('Imported {} PDF files from {} into the crawl manifest'.format(len(rows), folder))
+
+
+	def read_names(self, journal, year, status = 'downloaded'):
+
+		"""
+			Return the set of publication names of a journal and year with a certain status
+		"""
+
+		with self.lock:
+			return set(x[0] for x in self.connection.execute('SELECT name FROM manifest WHERE journal = ? AND year = ? AND status = ?', (journal, year, status)))
+
+
+	def add_discovered(self, rows):
+
+		"""
+			Register newly discovered publications in one transaction; publications already present keep their status
+
+			Parameters
+			----------
+			rows : list of tuples
+				journal, year, name, url and folder of each discovered publication
+		"""
+
+		now = datetime.now().isoformat()
+
+		with self.lock:
+			self.connection.executemany("""INSERT OR IGNORE INTO manifest (journal, year, name, url, folder, status, timestamp) 
+											VALUES (?, ?, ?, ?, ?, 'discovered', ?)""", [row + (now,) for row in rows])
+			self.connection.commit()
+
+
+	def update_status(self, journal, year, name, status, pdf_url = None, size = None, md5 = None):
+
+		"""
+			Update the status of a publication (e.g. 'downloaded' or 'failed'), together with its PDF link, file size and md5 checksum
+		"""
+
+		with self.lock:
+			self.connection.execute("""UPDATE manifest SET status = ?, pdf_url = COALESCE(?, pdf_url), size = COALESCE(?, size), md5 = COALESCE(?, md5), timestamp = ? 
+										WHERE journal = ? AND year = ? AND name = ?""", (status, pdf_url, size, md5, datetime.now().isoformat(), journal, year, name))
+			self.connection.commit()
+
+
+	def read_pending(self):
+
+		"""
+			Return all publications that have been discovered but are not downloaded yet, including failed downloads
+
+			Returns
+			-------
+			rows : list of tuples
+				journal, year, name, url, pdf_url and folder of each pending publication
+		"""
+
+		with self.lock:
+			return self.connection.execute("SELECT journal, year, name, url, pdf_url, folder FROM manifest WHERE status != 'downloaded'").fetchall()
+
+
+class WorkQueue:
+
+	"""
+		Work queue stored in MongoDB, so any number of processes on any number of machines can share a backlog (e.g. the PDF documents of 
+		full_text_preprocessing or the documents of general_preprocessing) without doing the same work twice. Each item is claimed atomically 
+		(find_one_and_update) together with a lease. While a worker processes its items, a heartbeat thread extends the lease. Items of a worker 
+		that crashed are claimed again by another worker once their lease has expired. An item is tried at most max_attempts times.
+
+		Items have the status 'pending', 'claimed', 'done' or 'failed'. The lease expiry is set with the clock of the worker, so the clocks of the 
+		machines should not differ more than a fraction of the lease time.
+
+		Usage:
+
+			queue = WorkQueue('full_text')
+			queue.add(keys)
+			for keys in queue.claim_batches(100):
+				# process the items; the batch is marked as done when the next batch is requested
+	"""
+
+	def __init__(self, name, database = None, lease_time = 600, max_attempts = 3):
+
+		"""
+			Parameters
+			----------
+			name : string
+				name of the queue; items of different queues are stored in the same collection
+			database : MongoDatabase (optional)
+				database to store the queue in. Default creates a new connection
+			lease_time : int (optional)
+				number of seconds a claimed item is reserved for a worker, unless the worker extends the lease with a heartbeat
+			max_attempts : int (optional)
+				maximum number of times an item is claimed
+		"""
+
+		self.name = name
+		self.lease_time = lease_time
+		self.max_attempts = max_attempts
+
+		# unique name of this worker
+		self.worker_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[0:6])
+
+		# keys released with fail since the last batch was completed
+		self.released = set()
+
+		self.collection = (database or MongoDatabase()).db['work_queue']
+		self.collection.create_index([('queue', ASCENDING), ('key', ASCENDING)], unique = True)
+		self.collection.create_index([('queue', ASCENDING), ('status', ASCENDING), ('lease_expires', ASCENDING)])
+
+
+	def add(self, keys):
+
+		"""
+			Add items to the queue in one round trip. Items that are already in the queue keep their status, so every worker can add the full backlog
+
+			Parameters
+			----------
+			keys : iterable
+				key of each item, e.g. the location of a file or the _id of a document
+		"""
+
+		keys = list(keys)
+
+		try:
+			if len(keys) > 0:
+				self.collection.bulk_write([UpdateOne({'queue' : self.name, 'key' : key}, {'$setOnInsert' : {'status' : 'pending', 'attempts' : 0}}, upsert = True) 
+											for key in keys], ordered = False)
+		except BulkWriteError, e:
+			# workers that add the same items at the same time cause duplicate key errors (11000), which can be ignored
+			errors = [x for x in e.details['writeErrors'] if x['code'] != 11000]
+			if len(errors) > 0:
+				logging.error("[{}] : {}".format(sys._getframe().f_code.co_name, errors[0]['errmsg']))
+				exit(1)
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def claim(self, n = 1):
+
+		"""
+			Claim up to n items that are pending or whose lease has expired. Items are claimed as a batch in a few round trips: the candidates are read,
+			claimed with one update that checks again that each of them is still available (so two workers can never claim the same item) and labeled
+			with a claim id, and the items with that claim id are read back. Candidates taken by another worker in the meantime are replaced.
+
+			Items whose lease expired on their last attempt (their worker crashed) are marked as failed, since they can not be claimed again.
+
+			Returns
+			-------
+			keys : list
+				keys of the claimed items; empty if the queue is drained
+		"""
+
+		keys = []
+
+		try:
+			now = datetime.utcnow()
+
+			# fail the items of crashed workers that used their last attempt
+			self.collection.update_many({'queue' : self.name, 'status' : 'claimed', 'lease_expires' : {'$lt' : now}, 'attempts' : {'$gte' : self.max_attempts}},
+										{'$set' : {'status' : 'failed', 'error' : 'lease expired on the last attempt'}, '$unset' : {'lease_expires' : ''}})
+
+			available = {'queue' : self.name, 'attempts' : {'$lt' : self.max_attempts}, '$or' : [{'status' : 'pending'}, {'status' : 'claimed', 'lease_expires' : {'$lt' : now}}]}
+
+			while len(keys) < n:
+
+				# candidate items
+				ids = [x['_id'] for x in self.collection.find(available, {'_id' : 1}).limit(n - len(keys))]
+				if len(ids) == 0:
+					break
+
+				# claim the candidates that are still available
+				claim_id = uuid.uuid4().hex
+				self.collection.update_many(dict(available, _id = {'$in' : ids}), 
+											{'$set' : {'status' : 'claimed', 'worker' : self.worker_id, 'claim' : claim_id, 'lease_expires' : now + timedelta(seconds = self.lease_time)}, 
+											'$inc' : {'attempts' : 1}})
+
+				keys.extend(x['key'] for x in self.collection.find({'queue' : self.name, 'claim' : claim_id}, {'key' : 1}))
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+		return keys
+
+
+	def heartbeat(self, keys):
+
+		"""
+			Extend the lease of items claimed by this worker
+		"""
+
+		self.collection.update_many({'queue' : self.name, 'key' : {'$in' : keys}, 'worker' : self.worker_id, 'status' : 'claimed'}, 
+									{'$set' : {'lease_expires' : datetime.utcnow() + timedelta(seconds = self.lease_time)}})
+
+
+	def complete(self, keys):
+
+		"""
+			Mark items claimed by this worker as done. Items whose lease has expired and that have been claimed by another worker are not changed
+		"""
+
+		try:
+			result = self.collection.update_many({'queue' : self.name, 'key' : {'$in' : keys}, 'worker' : self.worker_id, 'status' : 'claimed'}, 
+												{'$set' : {'status' : 'done'}, '$unset' : {'lease_expires' : ''}})
+
+			if result.modified_count < len(keys):
+				logging.warning('[{}] : {} items were no longer claimed by {}'.format(sys._getframe().f_code.co_name, len(keys) - result.modified_count, self.worker_id))
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def fail(self, keys, error = None):
+
+		"""
+			Release items claimed by this worker that could not be processed. They become pending again, or failed after max_attempts attempts
+		"""
+
+		# released items are not marked as done with the rest of their batch
+		self.released.update(keys)
+
+		try:
+			query = {'queue' : self.name, 'key' : {'$in' : keys}, 'worker' : self.worker_id, 'status' : 'claimed'}
+			for status, attempts in [('failed', {'$gte' : self.max_attempts}), ('pending', {'$lt' : self.max_attempts})]:
+				self.collection.update_many(dict(query, attempts = attempts), {'$set' : {'status' : status, 'error' : error}, '$unset' : {'lease_expires' : ''}})
+		except Exception, e:
+			logging.error("[{}] : {}".format(sys._getframe().f_code.co_name,e))
+			exit(1)
+
+
+	def counts(self):
+
+		"""
+			Return the number of items per status
+		"""
+
+		return {x['_id'] : x['count'] for x in self.collection.aggregate([{'$match' : {'queue' : self.name}}, {'$group' : {'_id' : '$status', 'count' : {'$sum' : 1}}}])}
+
+
+	def clear(self):
+
+		"""
+			Remove all items of the queue
+		"""
+
+		self.collection.delete_many({'queue' : self.name})
+
+
+	def start_heartbeat(self, keys):
+
+		"""
+			Extend the lease of items every third of the lease time in a background thread, until the returned event is set
+		"""
+
+		stop = threading.Event()
+
+		def beat():
+			while not stop.wait(self.lease_time / 3.):
+				try:
+					self.heartbeat(keys)
+				except Exception, e:
+					logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+
+		thread = threading.Thread(target = beat)
+		thread.daemon = True
+		thread.start()
+
+		return stop
+
+
+	def claim_batches(self, batch_size):
+
+		"""
+			Claim batches of items until the queue is drained. The lease of a batch is kept alive while it is processed, and the batch is marked as done 
+			when the next batch is requested. If processing raises an exception, the batch stays claimed and is picked up again after its lease expires
+
+			Parameters
+			----------
+			batch_size : int
+				number of items claimed at once
+
+			Yields
+			------
+			keys : list
+				keys of the claimed items
+		"""
+
+		while True:
+
+			keys = self.claim(batch_size)
+			if len(keys) == 0:
+				break
+
+			stop = self.start_heartbeat(keys)
+			try:
+				yield keys
+			finally:
+				stop.set()
+
+			# mark the batch as done, except the items that were released with fail
+			self.complete([key for key in keys if key not in self.released])
+			self.released.clear()
+
+		logging.info('Work queue {} drained: {}'.format(self.name, self.counts()))
+
+
+class LocalWorkQueue(WorkQueue):
+
+	"""
+		In-memory stand-in for the WorkQueue with the same behaviour (claims, leases, heartbeats and attempts), to run and test a distributed 
+		configuration locally without a database. Items are shared by the threads of one process only
+	"""
+
+	def __init__(self, name = 'local', lease_time = 600, max_attempts = 3):
+
+		self.name = name
+		self.lease_time = lease_time
+		self.max_attempts = max_attempts
+		self.worker_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[0:6])
+		self.released = set()
+
+		# status, worker, lease expiry and number of attempts of each item, in order of insertion
+		self.items = {}
+		self.order = []
+		self.lock = threading.Lock()
+
+
+	def add(self, keys):
+
+		with self.lock:
+			for key in keys:
+				if key not in self.items:
+					self.items[key] = {'status' : 'pending', 'worker' : None, 'lease_expires' : None, 'attempts' : 0}
+					self.order.append(key)
+
+
+	def claim(self, n = 1):
+
+		keys, now = [], datetime.utcnow()
+
+		with self.lock:
+
+			# fail the items of crashed workers that used their last attempt
+			for item in self.items.values():
+				if item['status'] == 'claimed' and item['lease_expires'] < now and item['attempts'] >= self.max_attempts:
+					item.update(status = 'failed', lease_expires = None, error = 'lease expired on the last attempt')
+
+			for key in self.order:
+
+				if len(keys) == n:
+					break
+
+				item = self.items[key]
+				if item['attempts'] < self.max_attempts and (item['status'] == 'pending' or (item['status'] == 'claimed' and item['lease_expires'] < now)):
+					item.update(status = 'claimed', worker = self.worker_id, lease_expires = now + timedelta(seconds = self.lease_time), attempts = item['attempts'] + 1)
+					keys.append(key)
+
+		return keys
+
+
+	def claimed_items(self, keys):
+
+		"""
+			Return the items of keys that are claimed by this worker
+		"""
+
+		return [self.items[key] for key in keys if key in self.items and self.items[key]['worker'] == self.worker_id and self.items[key]['status'] == 'claimed']
+
+
+	def heartbeat(self, keys):
+
+		with self.lock:
+			for item in self.claimed_items(keys):
+				item['lease_expires'] = datetime.utcnow() + timedelta(seconds = self.lease_time)
+
+
+	def complete(self, keys):
+
+		with self.lock:
+			for item in self.claimed_items(keys):
+				item.update(status = 'done', lease_expires = None)
+
+
+	def fail(self, keys, error = None):
+
+		self.released.update(keys)
+
+		with self.lock:
+			for item in self.claimed_items(keys):
+				item.update(status = 'failed' if item['attempts'] >= self.max_attempts else 'pending', lease_expires = None, error = error)
+
+
+	def counts(self):
+
+		with self.lock:
+			return dict(Counter(item['status'] for item in self.items.values()))
+
+
+	def clear(self):
+
+		with self.lock:
+			self.items, self.order = {}, []
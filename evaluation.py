@@ -47,6 +47,7 @@ import seaborn as sns
 import pandas as pd
 
 from database import MongoDatabase
+from hash_dictionary import HashedDictionary
 from helper_functions import *
 
 
@@ -80,7 +81,12 @@ class Evaluation():
 		dictionary, corpus = get_dic_corpus(file_folder)
 
 		# load bag of words features of each document from the database
-		texts = [x['tokens'] for x in self.db.read_collection('publications_raw')]
+		id2token = load_token_vocabulary()
+		texts = [get_document_tokens(x, id2token) for x in self.db.read_collection('publications_raw', projection = {'tokens' : 1, 'packed_tokens' : 1})]
+
+		# the texts of a hashed dictionary are looked up by the labels of the token ids, so all tokens of a bucket count as one token
+		if isinstance(dictionary, HashedDictionary):
+			dictionary, texts = dictionary.to_labels(texts)
 
 		# get path location for models
 		M = [x for x in read_directory(models_folder) if x.endswith('lda.model')]
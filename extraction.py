@@ -28,7 +28,9 @@
 """
 
 # modules and packages
-import logging, sys, re
+import logging, sys, re, time, threading, urlparse
+from multiprocessing.dummy import Pool as ThreadPool
+from database import MongoDatabase, CrawlManifest
 from helper_functions import *
 
 
@@ -38,23 +40,39 @@ class Extraction():
 
 		logging.info('Initialized {}'.format(self.__class__.__name__))		
 
-	def extract_publications(self, save_folder = os.path.join('files', 'pdf')):
+		# instantiate database
+		self.db = MongoDatabase()
+
+	def extract_publications(self, save_folder = os.path.join('files', 'pdf'), n_workers = 1, requests_per_second = None, cache_folder = os.path.join('files', 'cache', 'html')):
 
 		"""
 			Crawl the website and extract links to publications and download full-text pdf
 			This is only one example that works for the NIPS site. Other websites will need different
 			crawling techniques
 
+			Every discovered publication is recorded in a crawl manifest (save_folder/manifest.db) with its download status, so publications that have
+			already been downloaded are skipped without reading the PDF folders.
+
 			Parameters
 			----------
 			save_folder : os.path
 				folder location where PDFs need to be saved
+			n_workers : int (optional)
+				number of concurrent crawler threads. Default is 1, which crawls one page at a time
+			requests_per_second : float (optional)
+				maximum number of requests per second send to a single host, shared by all workers. Default is None (no limit)
+			cache_folder : os.path (optional)
+				location of the page cache for year and paper pages, so a re-crawl of an unchanged website only costs conditional requests. Set to None to disable
 		"""
 
 		# crawl the first page to retrieve links to next page
 		journal = 'NIPS'
 		domain = 'https://papers.nips.cc'
-		p1_content = return_html(domain).text
+
+		# set up the manifest, rate limiter and the pool of crawler threads
+		pool = self._setup_crawler(save_folder, n_workers, requests_per_second, cache_folder)
+
+		p1_content = self._return_html(domain).text
 		p1_links = re.findall(r'<a href="(/book.*?)">', p1_content) 
 
 		# go to second page
@@ -63,47 +81,293 @@ class Extraction():
 			# extract year from link
 			year = l[-4:]
 
+			# folder to save the PDFs of this year to
+			folder = os.path.join(save_folder, journal, year)
+
 			# construct link to second page
 			l2 = '{}{}'.format(domain, l)
 
 			# scrape content of second page
-			p2_content = return_html(l2).text
+			p2_content = self._return_html(l2).text
 
 			# retrieve all links of second page
 			p2_links = re.findall(r'<a href="(/paper.*?)">', p2_content)
 
-			# read publications from file so we don't process them again
-			processed_publications = [x.split(os.sep)[-1][0:-4] for x in read_directory(os.path.join(save_folder, journal, year))]
-			
+			# PDFs downloaded before the manifest existed are imported once
+			self.manifest.import_directory(journal, year, folder)
 
-			# extract links to third page, which is where the paper overviews are
-			for i, l2 in enumerate(p2_links):
+			# read publications from the manifest so we don't process them again
+			processed_publications = self.manifest.read_names(journal, year, status = 'downloaded')
 
-				logging.debug('Year: {} , Publication {}/{}'.format(year, i + 1, len(p2_links)))
+			# only crawl the paper pages that have not been downloaded yet
+			tasks = []
+			for i, l2 in enumerate(p2_links):
 
 				# check if publication already processed
-				if l2.split(os.sep)[-1] in processed_publications:
-					logging.debug('publication already present, skipping ...')
+				name = l2.split(os.sep)[-1]
+				if name in processed_publications:
+					logging.debug('Year: {} , Publication {}/{} already present, skipping ...'.format(year, i + 1, len(p2_links)))
 					continue
 
 				# construct link to third page
-				l3 = '{}{}'.format(domain, l2)
+				tasks.append((journal, year, name, '{}{}'.format(domain, l2), None, folder))
+
+			logging.info('Year: {} , downloading {}/{} publications'.format(year, len(tasks), len(p2_links)))
+
+			# record the discovered publications, so failed downloads can be resumed later
+			self.manifest.add_discovered([(t[0], t[1], t[2], t[3], t[5]) for t in tasks])
+
+			# download the publications, either one by one or by the pool of crawler threads
+			self._run_tasks(tasks, pool)
+
+		self._close_crawler(pool)
+
+	def resume_failed_downloads(self, save_folder = os.path.join('files', 'pdf'), n_workers = 1, requests_per_second = None, cache_folder = os.path.join('files', 'cache', 'html')):
+
+		"""
+			Download all publications in the crawl manifest that were discovered but not (successfully) downloaded, without crawling
+			the year pages again
+
+			Parameters
+			----------
+			save_folder : os.path
+				folder location where PDFs are saved, and where the crawl manifest is stored
+			n_workers : int (optional)
+				number of concurrent crawler threads
+			requests_per_second : float (optional)
+				maximum number of requests per second send to a single host, shared by all workers. Default is None (no limit)
+			cache_folder : os.path (optional)
+				location of the page cache. Set to None to disable
+		"""
+
+		# set up the manifest, rate limiter and the pool of crawler threads
+		pool = self._setup_crawler(save_folder, n_workers, requests_per_second, cache_folder)
+
+		# publications that still need to be downloaded
+		tasks = self.manifest.read_pending()
+
+		logging.info('Resuming {} pending downloads'.format(len(tasks)))
+
+		self._run_tasks(tasks, pool)
+		self._close_crawler(pool)
+
+	def ingest_publications(self, export_file, field_map = None, file_format = None, batch_size = 1000):
+
+		"""
+			Ingest publications (typically abstracts) from a bulk export, such as a Scopus or Web of Science export, into the publications_raw collection.
+			The export is streamed and written to the database in batches, so memory use is bounded by the batch size and not by the size of the export.
+			Publications with a journal, year and title that are already in the database (or earlier in the export) are skipped: duplicates within a 
+			batch are dropped before the insert, and duplicates of stored publications are rejected by the unique index on journal, year and title.
+
+			Parameters
+			----------
+			export_file : string
+				location of the JSON-lines or CSV export file
+			field_map : dictionary (optional)
+				maps the fields journal, year, title and content to the field or column names of the export, 
+				e.g. for a Scopus CSV export {'journal' : 'Source title', 'year' : 'Year', 'title' : 'Title', 'content' : 'Abstract'}.
+				Default is None, which expects the export to use journal, year, title and content
+			file_format : string (optional)
+				'jsonl' or 'csv'. If None, the format is derived from the file extension
+			batch_size : int (optional)
+				number of publications inserted into the database at once
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# fields of the export to read
+		fields = {'journal' : 'journal', 'year' : 'year', 'title' : 'title', 'content' : 'content'}
+		fields.update(field_map or {})
+
+		# make sure a publication can only be stored once; without the unique index, each batch is checked against the database
+		unique_index = self.db.create_unique_index(collection = 'publications_raw', keys = ['journal', 'year', 'title'])
+
+		# only the keys of the current batch are kept in memory
+		batch, batch_keys, num_inserted, num_skipped = [], set(), 0, 0
+
+		for record in read_export_records(export_file, file_format):
+
+			# prepare dictionary to save into MongoDB; the year is stored as a string, like the full-text publications
+			doc = {key : record.get(field) for key, field in fields.items()}
+			doc['year'] = unicode(doc['year']) if doc['year'] is not None else None
+
+			# skip records without content and publications that are already in the batch
+			key = (doc['journal'], doc['year'], doc['title'])
+			if not doc['content'] or key in batch_keys:
+				num_skipped += 1
+				continue
+
+			# hash of the content, so changed content can be detected (see Preprocessing.general_preprocessing)
+			doc['content_hash'] = get_content_hash(doc['content'])
+
+			batch_keys.add(key)
+			batch.append(doc)
+
+			# write batch to database; publications that are already stored count as skipped
+			if len(batch) >= batch_size:
+				inserted = self._insert_publications(batch, unique_index)
+				num_inserted, num_skipped = num_inserted + inserted, num_skipped + len(batch) - inserted
+				batch, batch_keys = [], set()
+				logging.debug('Ingested {} publications, skipped {}'.format(num_inserted, num_skipped))
+
+		# write the remaining publications; documents that the unique index rejects (e.g. inserted by another process) count as skipped
+		inserted = self._insert_publications(batch, unique_index)
+		num_inserted, num_skipped = num_inserted + inserted, num_skipped + len(batch) - inserted
+
+		logging.info('Ingested {} publications, skipped {}'.format(num_inserted, num_skipped))
+
+	def _insert_publications(self, batch, unique_index = True):
+
+		"""
+			Insert a batch of publications and return the number of inserted publications. Duplicates of stored publications are rejected by the unique 
+			index, or, if the index could not be created, removed with one query for the keys of the batch
+		"""
+
+		if not unique_index and len(batch) > 0:
+			stored = set((x.get('journal'), x.get('year'), x.get('title')) for x in self.db.read_collection(collection = 'publications_raw', 
+							query = {'$or' : [{'journal' : d['journal'], 'year' : d['year'], 'title' : d['title']} for d in batch]}, 
+							projection = {'journal' : 1, 'year' : 1, 'title' : 1, '_id' : 0}))
+			batch = [d for d in batch if (d['journal'], d['year'], d['title']) not in stored]
+
+		return self.db.insert_many_to_collection(collection = 'publications_raw', docs = batch, ignore_duplicates = True)
+
+	def _setup_crawler(self, save_folder, n_workers, requests_per_second, cache_folder):
+
+		"""
+			Create the crawl manifest, the rate limiter and the pool of crawler threads (None if only one worker is used)
+		"""
+
+		# manifest of discovered and downloaded publications
+		self.manifest = CrawlManifest(os.path.join(save_folder, 'manifest.db'))
+
+		# request budget per host, shared by all the crawler threads
+		self.rate_limiter = HostRateLimiter(requests_per_second)
+		self.cache_folder = cache_folder
+
+		# keep one pooled connection per crawler thread alive
+		get_session(pool_size = max(n_workers, 10))
+
+		# bounded pool of crawler threads (network bound, so threads are sufficient)
+		return ThreadPool(n_workers) if n_workers > 1 else None
+
+	def _run_tasks(self, tasks, pool):
+
+		"""
+			Download the publications of the tasks, either one by one or by the pool of crawler threads
+		"""
+
+		if pool is None:
+			for task in tasks:
+				self._download_publication(task)
+		else:
+			pool.map(self._download_publication, tasks)
+
+	def _close_crawler(self, pool):
+
+		"""
+			Stop the crawler threads and log the page cache statistics
+		"""
+
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+		logging.info('Page cache: {}'.format(get_page_cache_stats()))
+
+	def _download_publication(self, task):
+
+		"""
+			Scrape the paper overview page (third page) and download the PDF it links to. The result is recorded in the crawl manifest
+
+			Parameters
+			----------
+			task : tuple
+				journal, year, name, link to the paper overview page, link to the PDF (None if not known yet) and the folder to save the PDF to
+		"""
+
+		journal, year, name, l3, pdf_link, folder = task
+
+		# extract PDF link from page and download PDF
+		try:
+			if pdf_link is None:
 
 				# scrape content of the third page
-				p3_content = return_html(l3).text
-
-				# extract PDF link from page and download PDF
-				try:
-					pdf_link = '{}{}'.format(domain, re.findall(r'href="(/paper/.*\.pdf)">', p3_content)[0])
-					pdf_name = pdf_link.split('/')[-1:][0]
-
-					# download pdf
-					save_pdf(pdf_link, 
-								folder = os.path.join(save_folder, journal, year), 
-								name = pdf_name,
-								overwrite = False)
-				except Exception, e:
-					logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
-					continue
+				p3_content = self._return_html(l3).text
+
+				domain = '{0.scheme}://{0.netloc}'.format(urlparse.urlparse(l3))
+				pdf_link = '{}{}'.format(domain, re.findall(r'href="(/paper/.*\.pdf)">', p3_content)[0])
+			
+			pdf_name = pdf_link.split('/')[-1:][0]
+
+			# download pdf
+			self.rate_limiter.wait(pdf_link)
+			md5 = save_pdf(pdf_link, 
+						folder = folder, 
+						name = pdf_name,
+						overwrite = False)
+
+			# save_pdf returns None when the download failed, or when the PDF was already on disk
+			pdf_file = os.path.join(folder, pdf_name)
+			if md5 is None and os.path.exists(pdf_file):
+				md5 = get_file_md5(pdf_file)
+
+			if md5 is not None:
+				self.manifest.update_status(journal, year, name, 'downloaded', pdf_url = pdf_link, size = os.path.getsize(pdf_file), md5 = md5)
+			else:
+				self.manifest.update_status(journal, year, name, 'failed', pdf_url = pdf_link)
+
+		except Exception, e:
+			logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+			self.manifest.update_status(journal, year, name, 'failed', pdf_url = pdf_link)
+
+	def _return_html(self, url):
+
+		"""
+			Scrape html content from url while respecting the request budget of the host
+		"""
+
+		self.rate_limiter.wait(url)
+		return return_html(url, cache_folder = self.cache_folder)
+
+
+"""
+
+internal helper class
+
+"""
+
+class HostRateLimiter():
+
+	"""
+		Limit the number of requests per second send to each host. Thread-safe, so a single instance can be shared by all crawler threads
+	"""
+
+	def __init__(self, requests_per_second = None):
+
+		# minimum number of seconds between two requests to the same host
+		self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+
+		# time at which the next request to a host is allowed
+		self.next_request = {}
+		self.lock = threading.Lock()
+
+	def wait(self, url):
+
+		"""
+			Block until a request to the host of the url is within budget
+		"""
+
+		if self.interval == 0.0:
+			return
+
+		host = urlparse.urlparse(url).netloc
 
+		# reserve a time slot for this request
+		with self.lock:
+			now = time.time()
+			slot = max(now, self.next_request.get(host, now))
+			self.next_request[host] = slot + self.interval
 
+		# sleep outside of the lock so other hosts are not blocked
+		if slot > now:
+			time.sleep(slot - now)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""
+	Created by:	Shaheen Syed
+	Date:		August 2018
+
+	Dictionary with a fixed number of hashed buckets, as a bounded-memory alternative to the gensim Dictionary. With bigrams and entities, the vocabulary
+	of a large corpus can grow into the tens of millions of tokens before it is pruned by filter_extremes, and the gensim Dictionary keeps all of them in
+	memory. The HashedDictionary maps each token to one of num_buckets buckets (crc32 of the token) and only counts per bucket, so memory does not
+	grow with the size of the vocabulary.
+
+	Tokens that fall in the same bucket share a token id (a collision). To keep topics readable, the most frequent surface forms of each bucket are
+	kept in a side table of at most top_k tokens per bucket (space-saving counts), and a token id is shown as its surface forms, e.g. 'fish/fishery'.
+	The collision statistics show whether the number of buckets is large enough for the corpus.
+
+	The HashedDictionary can be used wherever the LDA phases expect a gensim dictionary (doc2bow, filter_extremes, filter_tokens, id2word, save and load):
+
+		dictionary = HashedDictionary(texts, num_buckets = 2 ** 20)
+		dictionary.filter_extremes(no_below = 5, no_above = 0.9)
+		corpus = [dictionary.doc2bow(text) for text in texts]
+
+	The exception are gensim functions that look up the tokens of texts in token2id, such as the CoherenceModel: token2id only contains the surface forms
+	in the side table, so all other tokens would be missed. For those, the texts and dictionary are first converted to the labels of the token ids 
+	(see to_labels), so all tokens of a bucket count as one token, like in the bag-of-words of doc2bow.
+"""
+
+# packages and modules
+import logging, sys, zlib, math
+from collections import Counter
+from operator import itemgetter
+import numpy as np
+from gensim import utils, corpora
+
+
+class HashedDictionary(utils.SaveLoad):
+
+	def __init__(self, documents = None, num_buckets = 2 ** 20, top_k = 3):
+
+		"""
+			Parameters
+			----------
+			documents : iterable (optional)
+				tokens of each document to add to the dictionary
+			num_buckets : int (optional)
+				number of buckets tokens are hashed to
+			top_k : int (optional)
+				number of surface forms kept per bucket
+		"""
+
+		self.num_buckets = num_buckets
+		self.top_k = top_k
+
+		# document frequency and collection frequency of each bucket
+		self.bucket_dfs = np.zeros(num_buckets, dtype = np.int64)
+		self.bucket_cfs = np.zeros(num_buckets, dtype = np.int64)
+
+		# most frequent surface forms of each bucket, as lists of [token, count]
+		self.surface_forms = {}
+
+		# token id of each bucket (-1 for buckets that are filtered), and the bucket of each token id
+		self.bucket2id = np.arange(num_buckets, dtype = np.int64)
+		self.id2bucket = np.arange(num_buckets, dtype = np.int64)
+
+		self.num_docs, self.num_pos, self.num_nnz = 0, 0, 0
+
+		# token2id and id2token, built on first use and cleared when the buckets or surface forms change
+		self._token2id, self._id2token = None, None
+
+		if documents is not None:
+			self.add_documents(documents)
+
+	def __len__(self):
+
+		return len(self.id2bucket)
+
+	def __iter__(self):
+
+		return iter(self.keys())
+
+	def __contains__(self, token_id):
+
+		return 0 <= token_id < len(self)
+
+	def __getitem__(self, token_id):
+
+		"""
+			Return the label of a token id: its surface forms, most frequent first, or the bucket number if no surface form is known
+		"""
+
+		slots = self.surface_forms.get(int(self.id2bucket[token_id]))
+
+		if not slots:
+			return u'bucket_{}'.format(self.id2bucket[token_id])
+
+		return u'/'.join(token for token, _ in sorted(slots, key = itemgetter(1), reverse = True))
+
+	def keys(self):
+
+		return range(len(self))
+
+	def get(self, token_id, default = None):
+
+		return self[token_id] if 0 <= token_id < len(self) else default
+
+	@property
+	def token2id(self):
+
+		"""
+			Token id of each known surface form; tokens outside the side table are not included (see to_labels)
+		"""
+
+		if getattr(self, '_token2id', None) is None:
+			self._token2id = {token : int(self.bucket2id[bucket]) for bucket, slots in self.surface_forms.iteritems() if self.bucket2id[bucket] != -1 for token, _ in slots}
+
+		return self._token2id
+
+	@property
+	def id2token(self):
+
+		if getattr(self, '_id2token', None) is None:
+			self._id2token = {token_id : self[token_id] for token_id in self.keys()}
+
+		return self._id2token
+
+	def clear_cache(self):
+
+		"""
+			Clear token2id and id2token, after the buckets or surface forms have changed
+		"""
+
+		self._token2id, self._id2token = None, None
+
+	def save(self, fname_or_handle, **kwargs):
+
+		# token2id and id2token are built again after loading
+		kwargs['ignore'] = set(kwargs.get('ignore', [])) | set(['_token2id', '_id2token'])
+
+		super(HashedDictionary, self).save(fname_or_handle, **kwargs)
+
+	def get_bucket(self, token):
+
+		"""
+			Return the bucket of a token
+		"""
+
+		if isinstance(token, unicode):
+			token = token.encode('utf8')
+
+		return (zlib.crc32(token) & 0xffffffff) % self.num_buckets
+
+	def add_documents(self, documents, prune_at = None):
+
+		"""
+			Update the bucket frequencies and surface forms with documents. The prune_at argument is ignored (memory is already bounded); it exists
+			for compatibility with the gensim Dictionary
+
+			Parameters
+			----------
+			documents : iterable
+				tokens of each document
+		"""
+
+		self.clear_cache()
+
+		for i, document in enumerate(documents):
+
+			if i % 10000 == 0:
+				logging.debug('Adding document #{} to {}'.format(i, self.__class__.__name__))
+
+			bucket_counts = Counter()
+			for token, count in Counter(document).iteritems():
+				bucket = self.get_bucket(token)
+				bucket_counts[bucket] += count
+				self.update_surface_forms(bucket, token, count)
+
+			buckets = np.fromiter(bucket_counts.iterkeys(), dtype = np.int64, count = len(bucket_counts))
+			counts = np.fromiter(bucket_counts.itervalues(), dtype = np.int64, count = len(bucket_counts))
+
+			self.bucket_dfs[buckets] += 1
+			self.bucket_cfs[buckets] += counts
+
+			self.num_docs += 1
+			self.num_pos += int(counts.sum())
+			self.num_nnz += len(bucket_counts)
+
+	def update_surface_forms(self, bucket, token, count):
+
+		"""
+			Count a surface form of a bucket. With all top_k slots taken, the least frequent surface form is replaced and its count is inherited (space-saving),
+			so frequent surface forms are kept even if they occur late in the corpus
+		"""
+
+		slots = self.surface_forms.get(bucket)
+
+		if slots is None:
+			self.surface_forms[bucket] = [[token, count]]
+			return
+
+		for slot in slots:
+			if slot[0] == token:
+				slot[1] += count
+				return
+
+		if len(slots) < self.top_k:
+			slots.append([token, count])
+		else:
+			smallest = min(slots, key = itemgetter(1))
+			smallest[0] = token
+			smallest[1] += count
+
+	def doc2bow(self, document, allow_update = False, return_missing = False):
+
+		"""
+			Convert the tokens of a document to a bag-of-words: a sorted list of (token id, frequency) tuples. Tokens in filtered buckets are skipped
+		"""
+
+		if allow_update:
+			self.add_documents([document])
+
+		counts = Counter()
+		for token in document:
+			token_id = self.bucket2id[self.get_bucket(token)]
+			if token_id != -1:
+				counts[int(token_id)] += 1
+
+		return sorted(counts.iteritems())
+
+	def filter_extremes(self, no_below = 5, no_above = 0.5, keep_n = 100000):
+
+		"""
+			Filter the buckets that are contained in less than no_below documents or in more than no_above (fraction) of the documents, and keep only the
+			keep_n most frequent buckets. Token ids are assigned again in order of the buckets, like the compactify of a gensim Dictionary
+		"""
+
+		dfs = self.bucket_dfs[self.id2bucket]
+
+		# buckets within the thresholds
+		good = np.where((dfs >= no_below) & (dfs <= int(no_above * self.num_docs)))[0]
+
+		# the keep_n most frequent buckets; ties are kept in order of the buckets
+		if keep_n is not None and len(good) > keep_n:
+			good = np.sort(good[np.argsort(-dfs[good], kind = 'mergesort')[:keep_n]])
+
+		self.keep_ids(good)
+
+		logging.info('Kept {} of {} buckets'.format(len(self.id2bucket), len(dfs)))
+
+	def filter_tokens(self, bad_ids = None, good_ids = None):
+
+		"""
+			Remove the token ids in bad_ids, and/or keep only the token ids in good_ids. Token ids are assigned again in order, like the gensim Dictionary
+		"""
+
+		keep = np.ones(len(self), dtype = bool)
+
+		if good_ids is not None:
+			keep[:] = False
+			keep[list(good_ids)] = True
+		if bad_ids is not None:
+			keep[list(bad_ids)] = False
+
+		self.keep_ids(np.where(keep)[0])
+
+	def keep_ids(self, token_ids):
+
+		"""
+			Keep the buckets of the sorted token_ids, and number them from 0
+		"""
+
+		self.clear_cache()
+
+		self.id2bucket = self.id2bucket[token_ids]
+		self.bucket2id = np.full(self.num_buckets, -1, dtype = np.int64)
+		self.bucket2id[self.id2bucket] = np.arange(len(self.id2bucket))
+
+		# surface forms of filtered buckets are no longer needed
+		kept = set(self.id2bucket.tolist())
+		self.surface_forms = {bucket : slots for bucket, slots in self.surface_forms.iteritems() if bucket in kept}
+
+	def to_labels(self, documents):
+
+		"""
+			Convert the dictionary and documents to the labels of the token ids (see __getitem__), for gensim functions that look up the tokens of texts 
+			in token2id, such as the CoherenceModel
+
+			Parameters
+			----------
+			documents : iterable
+				tokens of each document
+
+			Returns
+			-------
+			dictionary : corpora.Dictionary
+				gensim dictionary with the label of each token id as its token, and the same token ids
+			texts : list
+				labels of the tokens of each document; tokens in filtered buckets are skipped
+		"""
+
+		labels = [self[token_id] for token_id in self.keys()]
+
+		dictionary = corpora.Dictionary()
+		dictionary.token2id = {label : token_id for token_id, label in enumerate(labels)}
+		dictionary.dfs = {token_id : int(df) for token_id, df in enumerate(self.bucket_dfs[self.id2bucket])}
+		dictionary.num_docs, dictionary.num_pos, dictionary.num_nnz = self.num_docs, self.num_pos, self.num_nnz
+
+		texts = []
+		for document in documents:
+			token_ids = (self.bucket2id[self.get_bucket(token)] for token in document)
+			texts.append([labels[token_id] for token_id in token_ids if token_id != -1])
+
+		return dictionary, texts
+
+	def collision_stats(self):
+
+		"""
+			Return statistics on how well the buckets separate the vocabulary
+
+			Returns
+			-------
+			stats : dictionary
+				num_buckets				number of buckets
+				occupied_buckets		number of buckets with at least one token
+				estimated_tokens		estimate of the number of unique tokens (linear counting over the empty buckets); None if all buckets are occupied
+				estimated_collisions	estimate of the number of tokens that share a bucket with another token
+				multi_form_buckets		number of kept buckets where more than one surface form was seen
+				purity					mean fraction of the collection frequency of a kept bucket that belongs to its most frequent surface form
+		"""
+
+		occupied = int(np.count_nonzero(self.bucket_cfs))
+		empty = self.num_buckets - occupied
+
+		estimated_tokens = int(round(-self.num_buckets * math.log(float(empty) / self.num_buckets))) if empty > 0 else None
+
+		purity = []
+		for bucket in self.id2bucket.tolist():
+			slots = self.surface_forms.get(bucket)
+			if slots and self.bucket_cfs[bucket] > 0:
+				purity.append(min(1.0, float(max(count for _, count in slots)) / self.bucket_cfs[bucket]))
+
+		return {'num_buckets' : self.num_buckets,
+				'occupied_buckets' : occupied,
+				'estimated_tokens' : estimated_tokens,
+				'estimated_collisions' : estimated_tokens - occupied if estimated_tokens is not None else None,
+				'multi_form_buckets' : sum(1 for bucket in self.id2bucket.tolist() if len(self.surface_forms.get(bucket, [])) > 1),
+				'purity' : sum(purity) / len(purity) if len(purity) > 0 else None}
@@ -6,13 +6,26 @@
 """
 
 # packages and modules
-import logging, os, requests, textract, glob2, sys, csv
+import logging, os, requests, textract, glob2, sys, csv, hashlib, json, threading, zlib, itertools, subprocess
+from collections import Counter
+from requests.adapters import HTTPAdapter
+from bson.binary import Binary
+import numpy as np
 from datetime import datetime
 import spacy
 import nltk
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 from gensim import corpora, models
+from binary_corpus import BinaryCorpus
+
+# shared keep-alive HTTP session (see get_session)
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+# counters of the on-disk page cache used by return_html
+PAGE_CACHE_STATS = {'hits' : 0, 'misses' : 0, 'bytes_saved' : 0}
+PAGE_CACHE_LOCK = threading.Lock()
 
 def set_logger(folder_name = 'logs'):
 
@@ -78,7 +91,37 @@ def get_HTTPHeaders():
 				"Accept-Language": "en-US,en;q=0.5"}
 
 
-def return_html(url):
+def get_session(pool_size = 10):
+
+	"""
+		Return the shared HTTP session. The session keeps connections alive and pools them per host, so consecutive requests to the same
+		website do not open a new connection each time
+
+		Parameters
+		----------
+		pool_size : int (optional)
+			maximum number of connections kept open per host. Only used when the session is created
+
+		Returns
+		-------
+		session : requests.Session
+			shared session with browser http headers
+	"""
+
+	global SESSION
+
+	with SESSION_LOCK:
+		if SESSION is None:
+			SESSION = requests.Session()
+			SESSION.headers.update(get_HTTPHeaders())
+			adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+			SESSION.mount('http://', adapter)
+			SESSION.mount('https://', adapter)
+
+	return SESSION
+
+
+def return_html(url, cache_folder = None):
 
 	"""
 		Scrape html content from url
@@ -87,6 +130,9 @@ def return_html(url):
 		---------
 		url : string
 			http link to a website
+		cache_folder : os.path (optional)
+			location of the on-disk page cache. If given, pages are stored together with their ETag/Last-Modified header and a conditional request
+			is send on the next call, so an unchanged page only costs a 304 response. Default is None (no caching)
 
 		Returns
 		-------
@@ -95,10 +141,28 @@ def return_html(url):
 	"""
 
 	try:
+		# read the cached version of the page and make the request conditional
+		headers = {}
+		cached = read_page_cache(url, cache_folder) if cache_folder is not None else None
+		if cached is not None:
+			if cached.headers.get('ETag') is not None:
+				headers['If-None-Match'] = cached.headers['ETag']
+			if cached.headers.get('Last-Modified') is not None:
+				headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
 		# retrieve html content
-		html = requests.get(url, headers=get_HTTPHeaders())
+		html = get_session().get(url, headers = headers)
+
+		# page has not changed, return the cached version
+		if html.status_code == requests.codes.not_modified and cached is not None:
+			update_page_cache_stats(hits = 1, bytes_saved = len(cached.content))
+			return cached
+
 		# check for status
 		if html.status_code == requests.codes.ok:
+			if cache_folder is not None:
+				update_page_cache_stats(misses = 1)
+				write_page_cache(url, html, cache_folder)
 			return html
 		else:
 			logging.error("[return_html] invalid status code: {}".format(html.status_code))
@@ -108,11 +172,135 @@ def return_html(url):
 		return None
 
 
-def save_pdf(url, folder, name, overwrite = True):
+def get_page_cache_file(url, cache_folder):
+
+	"""
+		Return the file location of a cached page (without extension); the cache is keyed by the sha1 of the url
+	"""
+
+	if isinstance(url, unicode):
+		url = url.encode('utf8')
+
+	return os.path.join(cache_folder, hashlib.sha1(url).hexdigest())
+
+
+def read_page_cache(url, cache_folder):
+
+	"""
+		Read a page from the on-disk page cache
+
+		Parameters
+		----------
+		url : string
+			http link to a website
+		cache_folder : os.path
+			location of the page cache
+
+		Returns
+		-------
+		html : request html object
+			cached html page with its ETag and Last-Modified header, or None if the page is not cached
+	"""
+
+	cache_file = get_page_cache_file(url, cache_folder)
+
+	if not (os.path.exists(cache_file + '.json') and os.path.exists(cache_file + '.html')):
+		return None
+
+	try:
+		with open(cache_file + '.json', 'r') as f:
+			meta = json.load(f)
+
+		# rebuild a response object so callers can use it as a normal response
+		html = requests.models.Response()
+		with open(cache_file + '.html', 'rb') as f:
+			html._content = f.read()
+		html.status_code = requests.codes.ok
+		html.url = meta['url']
+		html.encoding = meta['encoding']
+		for header in ['ETag', 'Last-Modified']:
+			if meta.get(header) is not None:
+				html.headers[header] = meta[header]
+
+		return html
+	except Exception, e:
+		logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		return None
+
+
+def write_page_cache(url, html, cache_folder):
+
+	"""
+		Save a page to the on-disk page cache. Pages without an ETag or Last-Modified header can not be validated and are not cached
+
+		Parameters
+		----------
+		url : string
+			http link to a website
+		html : request html object
+			the response of the page
+		cache_folder : os.path
+			location of the page cache
+	"""
+
+	if html.headers.get('ETag') is None and html.headers.get('Last-Modified') is None:
+		return
+
+	create_directory(cache_folder)
+
+	cache_file = get_page_cache_file(url, cache_folder)
+	meta = {'url' : url, 'encoding' : html.encoding, 'ETag' : html.headers.get('ETag'), 'Last-Modified' : html.headers.get('Last-Modified')}
+
+	try:
+		# write to temporary files first and rename them, so concurrent readers never see a half written page
+		with open(cache_file + '.html.tmp', 'wb') as f:
+			f.write(html.content)
+		with open(cache_file + '.json.tmp', 'w') as f:
+			json.dump(meta, f)
+		os.rename(cache_file + '.html.tmp', cache_file + '.html')
+		os.rename(cache_file + '.json.tmp', cache_file + '.json')
+	except Exception, e:
+		logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+
+
+def update_page_cache_stats(hits = 0, misses = 0, bytes_saved = 0):
+
+	"""
+		Update the page cache counters (thread-safe)
+	"""
+
+	with PAGE_CACHE_LOCK:
+		PAGE_CACHE_STATS['hits'] += hits
+		PAGE_CACHE_STATS['misses'] += misses
+		PAGE_CACHE_STATS['bytes_saved'] += bytes_saved
+
+
+def get_page_cache_stats():
+
+	"""
+		Return the page cache counters
+
+		Returns
+		-------
+		stats : dictionary
+			number of cache hits (304 responses), cache misses (full downloads) and the number of bytes that did not need to be downloaded
+	"""
+
+	with PAGE_CACHE_LOCK:
+		return dict(PAGE_CACHE_STATS)
+
+
+def save_pdf(url, folder, name, overwrite = True, expected_md5 = None, chunk_size = 64 * 1024):
 
 	"""
 		Save PDF file from the web to disk
 
+		The PDF is streamed in chunks to a temporary .part file, which is renamed to its final name only when the download is complete. An
+		interrupted download leaves the .part file behind, and the next call resumes it with an HTTP Range request. The validator of the download (the
+		ETag, or else the Last-Modified date) is stored next to the .part file and send as If-Range, so if the PDF changed on the server, the server
+		returns the full PDF and the .part file is written again. A .part file without a validator is not resumed, and a .part file that fails the size 
+		or checksum check is removed.
+
 		Parameters
 		-----------
 		url : string
@@ -123,31 +311,157 @@ def save_pdf(url, folder, name, overwrite = True):
 			name of the PDF file
 		overwrite: Boolean (optional)
 			if PDF already on disk, set to True if needs to be overwritten, or False to skip
+		expected_md5 : string (optional)
+			md5 hex digest the downloaded file should have. If it does not match, the download is discarded
+		chunk_size : int (optional)
+			number of bytes read and written at once
+
+		Returns
+		-------
+		md5 : string
+			md5 hex digest of the saved PDF file, or None if the PDF was skipped or could not be downloaded
 	"""
 
 	# create folder if not exists
 	create_directory(folder)
 
+	# final and temporary location of the pdf file
+	file_name = os.path.join(folder, name)
+	part_file_name = file_name + '.part'
+	validator_file_name = part_file_name + '.validator'
+
 	# check if file exists
-	file_exists = os.path.exists(os.path.join(folder, name))
+	file_exists = os.path.exists(file_name)
 
 	# retrieve PDF from web
 	if overwrite == True or file_exists == False:
 		
 		try:
-			# retrieve pdf content
-			response = requests.get(url, headers= get_HTTPHeaders(), stream=True)
+			# resume a previously interrupted download, but only of the same version of the PDF
+			offset = os.path.getsize(part_file_name) if os.path.exists(part_file_name) else 0
+			validator = read_validator(validator_file_name) if offset > 0 else None
+			headers = {'Range' : 'bytes={}-'.format(offset), 'If-Range' : validator} if validator is not None else {}
 
-			# save to folder
-			with open('{}/{}'.format(folder, name), 'wb') as f:
-				f.write(response.content)
+			# retrieve pdf content
+			response = get_session().get(url, headers = headers, stream = True)
+
+			if response.status_code == requests.codes.partial_content:
+				# server continues where we left off; total size is the part after the slash in 'bytes 100-199/200'
+				mode = 'ab'
+				expected_size = response.headers.get('Content-Range', '').split('/')[-1]
+			elif response.status_code == requests.codes.ok:
+				# server does not support ranges, the PDF changed, or nothing to resume: start from scratch
+				mode = 'wb'
+				expected_size = response.headers.get('Content-Length')
+				save_validator(validator_file_name, response.headers)
+			elif response.status_code == requests.codes.requested_range_not_satisfiable:
+				# partial file is invalid for the current version of the PDF, start over
+				logging.warning('[{}] : cannot resume {}, restarting download'.format(sys._getframe().f_code.co_name, name))
+				remove_partial_download(part_file_name)
+				return save_pdf(url, folder, name, overwrite, expected_md5, chunk_size)
+			else:
+				logging.error('[{}] : invalid status code {} for {}'.format(sys._getframe().f_code.co_name, response.status_code, url))
+				return None
+
+			# stream to the temporary file, so memory use does not depend on the size of the PDF
+			with open(part_file_name, mode) as f:
+				for chunk in response.iter_content(chunk_size = chunk_size):
+					if chunk:
+						f.write(chunk)
+
+			# check the size; content that was encoded for transfer (e.g. gzip) is decoded while streaming and cannot be compared
+			size = os.path.getsize(part_file_name)
+			if expected_size and expected_size.isdigit() and response.headers.get('Content-Encoding') is None and size != int(expected_size):
+				logging.error('[{}] : incomplete download of {}: {} of {} bytes'.format(sys._getframe().f_code.co_name, name, size, expected_size))
+				remove_partial_download(part_file_name)
+				return None
+
+			# check the checksum
+			md5 = get_file_md5(part_file_name)
+			if expected_md5 is not None and md5 != expected_md5:
+				logging.error('[{}] : checksum mismatch for {}, discarding download'.format(sys._getframe().f_code.co_name, name))
+				remove_partial_download(part_file_name)
+				return None
+
+			# the pdf is complete, move it to its final location
+			os.rename(part_file_name, file_name)
+			remove_partial_download(part_file_name)
+
+			return md5
 
 		except Exception, e:
+			# don't exit here; a failed download should not stop the other crawler threads
 			logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
-			exit(1)
+			return None
+
+
+def save_validator(validator_file_name, headers):
+
+	"""
+		Save the validator of a download next to its .part file: the ETag if it is a strong ETag (weak ETags can not be used with If-Range), or else the 
+		Last-Modified date. Without a validator, any previous validator is removed, so the download is not resumed
+	"""
+
+	etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+	validator = etag if etag is not None and not etag.startswith('W/') else last_modified
+
+	if validator is None:
+		if os.path.exists(validator_file_name):
+			os.remove(validator_file_name)
+		return
 
+	with open(validator_file_name, 'wb') as f:
+		f.write(validator)
 
-def pdf_to_plain(pdf_file):
+def read_validator(validator_file_name):
+
+	"""
+		Return the validator of a partial download, or None if there is none
+	"""
+
+	if not os.path.exists(validator_file_name):
+		return None
+
+	with open(validator_file_name, 'rb') as f:
+		return f.read().strip() or None
+
+def remove_partial_download(part_file_name):
+
+	"""
+		Remove the .part file of a download and its validator, if they exist
+	"""
+
+	for file_name in [part_file_name, part_file_name + '.validator']:
+		if os.path.exists(file_name):
+			os.remove(file_name)
+
+
+def get_file_md5(file_name, chunk_size = 64 * 1024):
+
+	"""
+		Calculate the md5 hex digest of a file, reading it in chunks
+
+		Parameters
+		----------
+		file_name : os.path
+			location of the file
+		chunk_size : int (optional)
+			number of bytes read at once
+
+		Returns
+		-------
+		md5 : string
+			md5 hex digest
+	"""
+
+	md5 = hashlib.md5()
+	with open(file_name, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			md5.update(chunk)
+	return md5.hexdigest()
+
+
+def pdf_to_plain(pdf_file, timeout = None):
 
 	
 	"""
@@ -157,6 +471,9 @@ def pdf_to_plain(pdf_file):
 		----------
 		pdf_file : string
 			location of pdf file
+		timeout : int (optional)
+			maximum number of seconds the conversion may take. The pdftotext process (the converter textract uses for PDF files) is then run directly 
+			and killed when it takes longer, so no conversion process is left running. Default is None (no time limit)
 
 		Returns
 		---------
@@ -168,13 +485,187 @@ def pdf_to_plain(pdf_file):
 	try:
 
 		# use textract to convert PDF to plain text
-		return textract.process(pdf_file, encoding='utf8')
+		if timeout is None:
+			return textract.process(pdf_file, encoding='utf8')
+
+		process = subprocess.Popen(['pdftotext', pdf_file, '-'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+
+		# kill the process when the time limit is reached; the process may just have finished
+		def kill():
+			try:
+				process.kill()
+			except OSError:
+				pass
+
+		timer = threading.Timer(timeout, kill)
+		timer.start()
+		try:
+			content, error = process.communicate()
+		finally:
+			timer.cancel()
+
+		if process.returncode != 0:
+			raise Exception('conversion took longer than {} seconds'.format(timeout) if process.returncode == -9 else 'pdftotext failed: {}'.format(error.strip()))
+
+		return content
 
 	except Exception, e:
 		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
 		return None
 		
 
+def cached_pdf_to_plain(pdf_file, cache_folder, timeout = None):
+
+	"""
+		Convert PDF file to plain text, using a cache of earlier conversions. The cache is content-addressed: the key is the md5 of the PDF file,
+		so a renamed or moved PDF is still found, and a changed PDF is converted again. Cached texts are stored zlib compressed.
+
+		Parameters
+		----------
+		pdf_file : string
+			location of pdf file
+		cache_folder : os.path
+			location of the text cache
+		timeout : int (optional)
+			maximum number of seconds the conversion may take (see pdf_to_plain)
+
+		Returns
+		---------
+		plain_pdf : string
+			plain text version of the PDF file, or None if the PDF could not be converted
+		cache_hit : Boolean
+			True if the plain text was read from the cache
+	"""
+
+	try:
+		cache_file = get_text_cache_file(pdf_file, cache_folder)
+
+		# read from cache, and mark as recently used for the eviction
+		if os.path.exists(cache_file):
+			with open(cache_file, 'rb') as f:
+				content = zlib.decompress(f.read())
+			os.utime(cache_file, None)
+			return content, True
+
+	except (IOError, OSError, zlib.error), e:
+		logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		return pdf_to_plain(pdf_file, timeout), False
+
+	# convert pdf to plain text
+	content = pdf_to_plain(pdf_file, timeout)
+
+	# save to cache; write to a temporary file first so a killed run does not leave a broken cache entry
+	if content is not None:
+		try:
+			create_directory(os.path.dirname(cache_file))
+			with open(cache_file + '.tmp', 'wb') as f:
+				f.write(zlib.compress(content))
+			os.rename(cache_file + '.tmp', cache_file)
+		except Exception, e:
+			logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+
+	return content, False
+
+
+def get_text_cache_file(pdf_file, cache_folder):
+
+	"""
+		Return the location of the cached plain text of a PDF file; the key is the md5 of the PDF file (see cached_pdf_to_plain)
+	"""
+
+	key = get_file_md5(pdf_file)
+
+	return os.path.join(cache_folder, key[0:2], key + '.txt.z')
+
+
+def read_text_cache(pdf_file, cache_folder):
+
+	"""
+		Return the cached plain text of a PDF file, or None if the PDF file has not been converted before, without converting it
+
+		Parameters
+		----------
+		pdf_file : string
+			location of pdf file
+		cache_folder : os.path
+			location of the text cache
+
+		Returns
+		---------
+		plain_pdf : string
+			plain text version of the PDF file, or None if it is not in the cache
+	"""
+
+	try:
+		cache_file = get_text_cache_file(pdf_file, cache_folder)
+		if not os.path.exists(cache_file):
+			return None
+
+		with open(cache_file, 'rb') as f:
+			content = zlib.decompress(f.read())
+		os.utime(cache_file, None)
+		return content
+
+	except (IOError, OSError, zlib.error), e:
+		logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		return None
+
+
+def evict_text_cache(cache_folder, max_size):
+
+	"""
+		Remove the least recently used texts from the text cache until the cache is no larger than max_size
+
+		Parameters
+		----------
+		cache_folder : os.path
+			location of the text cache
+		max_size : int
+			maximum size of the cache in bytes
+
+		Returns
+		-------
+		num_evicted : int
+			number of removed texts
+	"""
+
+	# size and last use of each cached text
+	cache_files = [(os.path.getmtime(x), os.path.getsize(x), x) for x in read_directory(cache_folder) if x.endswith('.txt.z')]
+	cache_size = sum(x[1] for x in cache_files)
+
+	num_evicted = 0
+	for _, size, cache_file in sorted(cache_files):
+		if cache_size <= max_size:
+			break
+		os.remove(cache_file)
+		cache_size -= size
+		num_evicted += 1
+
+	return num_evicted
+
+
+def get_content_hash(content):
+
+	"""
+		Return the sha1 hex digest of the (utf8 encoded) content of a document, used to detect changed content
+
+		Parameters
+		----------
+		content : string
+			content of a document
+
+		Returns
+		-------
+		content_hash : string
+			sha1 hex digest
+	"""
+
+	if isinstance(content, unicode):
+		content = content.encode('utf8')
+
+	return hashlib.sha1(content).hexdigest()
+
+
 def read_directory(directory):
 
 	"""
@@ -230,6 +721,17 @@ def get_bigrams(text):
 		exit(1)
 
 
+def get_document_bigrams(unigrams, min_bigram_count):
+
+	"""
+		Get the bigrams that occur at least min_bigram_count times within a document; each bigram is repeated as many times as it occurs
+	"""
+
+	bigrams = get_bigrams(" ".join(unigrams))
+	bigrams = [['{} {}'.format(x[0],x[1])] * y for x, y in Counter(bigrams).most_common() if y >= min_bigram_count]
+	return list(itertools.chain(*bigrams))
+
+
 def named_entity_recognition(text):
 
 	"""
@@ -246,6 +748,206 @@ def named_entity_recognition(text):
 		exit(1)
 
 
+def split_content(content, max_length):
+
+	"""
+		Split content into chunks of at most max_length characters. A chunk ends at the last end of a sentence in its second half, or else at the last 
+		space; only content without any of them is cut within a word. The content is expected to be whitespace normalized, so paragraph boundaries are 
+		not used. Content of at most max_length characters is returned as a single chunk
+
+		Parameters
+		----------
+		content : string
+			content of a document
+		max_length : int
+			maximum number of characters of a chunk
+
+		Yields
+		------
+		chunk : string
+			consecutive part of the content
+	"""
+
+	start = 0
+	while len(content) - start > max_length:
+
+		end = start + max_length
+
+		# last boundary within the second half of the chunk, in order of preference
+		for separator in ['. ', ' ']:
+			position = content.rfind(separator, start + max_length // 2, end)
+			if position != -1:
+				end = position + len(separator)
+				break
+
+		yield content[start:end]
+		start = end
+
+	yield content[start:]
+
+
+def get_batches(iterable, batch_size):
+
+	"""
+		Split an iterable (e.g. a database cursor) into lists of batch_size items, without reading the full iterable into memory
+
+		Parameters
+		----------
+		iterable : iterable
+			items to split into batches
+		batch_size : int
+			maximum number of items per batch
+
+		Returns
+		-------
+		batches : generator of lists
+			batches of items; the last batch can be smaller
+	"""
+
+	batch = []
+	for item in iterable:
+		batch.append(item)
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+	if len(batch) > 0:
+		yield batch
+
+
+def load_token_vocabulary(folder = os.path.join('files', 'tokens')):
+
+	"""
+		Load the corpus-level vocabulary of the packed tokens (see Preprocessing.pack_tokens). The vocabulary file contains one JSON encoded 
+		token per line; the line number is the integer id of the token
+
+		Parameters
+		----------
+		folder : os.path (optional)
+			location of the vocabulary file
+
+		Returns
+		-------
+		id2token : list
+			token of each integer id; empty if no tokens have been packed yet
+	"""
+
+	vocabulary_file = os.path.join(folder, 'vocabulary.txt')
+
+	if not os.path.exists(vocabulary_file):
+		return []
+
+	try:
+		with open(vocabulary_file, 'rb') as f:
+			return [json.loads(line) for line in f]
+	except Exception, e:
+		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		exit(1)
+
+
+def save_token_vocabulary(id2token, start, folder = os.path.join('files', 'tokens')):
+
+	"""
+		Append the tokens from index start onwards to the vocabulary file of the packed tokens
+
+		Parameters
+		----------
+		id2token : list
+			token of each integer id
+		start : int
+			first id that is not in the vocabulary file yet
+		folder : os.path (optional)
+			location of the vocabulary file
+	"""
+
+	create_directory(folder)
+
+	try:
+		with open(os.path.join(folder, 'vocabulary.txt'), 'ab') as f:
+			for token in id2token[start:]:
+				f.write(json.dumps(token) + '\n')
+	except Exception, e:
+		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		exit(1)
+
+
+def encode_tokens(tokens, token2id, id2token):
+
+	"""
+		Pack a list of tokens into a binary array of 32 bit integers. Tokens that are not in the vocabulary yet are added to it
+
+		Parameters
+		----------
+		tokens : list
+			tokens of a document
+		token2id : dictionary
+			integer id of each token; updated with new tokens
+		id2token : list
+			token of each integer id; updated with new tokens
+
+		Returns
+		-------
+		packed_tokens : bson.binary.Binary
+			little-endian 32 bit integer ids of the tokens
+	"""
+
+	ids = []
+	for token in tokens:
+		token_id = token2id.get(token)
+		if token_id is None:
+			token_id = token2id[token] = len(id2token)
+			id2token.append(token)
+		ids.append(token_id)
+
+	return Binary(np.asarray(ids, dtype = '<u4').tostring())
+
+
+def decode_tokens(packed_tokens, id2token):
+
+	"""
+		Unpack a binary array of 32 bit integers into the list of tokens
+
+		Parameters
+		----------
+		packed_tokens : bytes
+			little-endian 32 bit integer ids of the tokens
+		id2token : list
+			token of each integer id
+
+		Returns
+		-------
+		tokens : list
+			tokens of a document
+	"""
+
+	return [id2token[i] for i in np.frombuffer(packed_tokens, dtype = '<u4').tolist()]
+
+
+def get_document_tokens(doc, id2token):
+
+	"""
+		Return the tokens of a document from the database, either stored as a list of strings (tokens) or packed into integers (packed_tokens).
+		Plain tokens take precedence, since they are newer when a document was tokenized again after packing
+
+		Parameters
+		----------
+		doc : dictionary
+			document from the database
+		id2token : list
+			token of each integer id (see load_token_vocabulary)
+
+		Returns
+		-------
+		tokens : list
+			tokens of the document, or None if the document has not been tokenized
+	"""
+
+	if doc.get('tokens') is not None:
+		return doc['tokens']
+	if doc.get('packed_tokens') is not None:
+		return decode_tokens(doc['packed_tokens'], id2token)
+	return None
+
+
 def get_dic_corpus(file_folder):
 
 	"""
@@ -259,14 +961,16 @@ def get_dic_corpus(file_folder):
 		Returns
 		dictionary : dict()
 			LDA dictionary
-		corpus : mm
-			LDA corpus
+		corpus : mm or BinaryCorpus
+			LDA corpus; the memory-mapped binary corpus if it is more recent than the MatrixMarket corpus
 	"""
 
 	# create full path of dictionary
 	dic_path = os.path.join(file_folder, 'dictionary.dict')
 	# create full path of corpus
 	corpus_path = os.path.join(file_folder, 'corpus.mm')
+	# create full path of binary corpus
+	binary_corpus_path = os.path.join(file_folder, 'corpus.csr')
 
 
 	# check if dictionary exists
@@ -276,8 +980,10 @@ def get_dic_corpus(file_folder):
 		logging.error('LDA dictionary not found')
 		exit(1)
 
-	# check if corpus exists
-	if os.path.exists(corpus_path):
+	# check if corpus exists, and which format was written last
+	if os.path.exists(binary_corpus_path) and (not os.path.exists(corpus_path) or os.path.getmtime(binary_corpus_path) >= os.path.getmtime(corpus_path)):
+		corpus = BinaryCorpus(binary_corpus_path)
+	elif os.path.exists(corpus_path):
 		corpus = corpora.MmCorpus(corpus_path)
 	else:
 		logging.error('LDA corpus not found')
@@ -421,4 +1127,50 @@ def read_csv(filename, folder = None):
 			return list(reader)
 	except Exception, e:
 		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
-		exit(1)
\ No newline at end of file
+		exit(1)
+
+
+def read_export_records(export_file, file_format = None):
+
+	"""
+		Stream the records of a bulk export file (e.g. from Scopus or Web of Science) one by one, so the file is never loaded into memory
+
+		Parameters
+		----------
+		export_file : string
+			location of the export file
+		file_format : string (optional)
+			'jsonl' (one JSON object per line) or 'csv' (with header row). If None, the format is derived from the file extension
+
+		Returns
+		-------
+		records : generator of dictionaries
+			one dictionary per record, with the field or column names as keys
+	"""
+
+	if file_format is None:
+		file_format = 'csv' if export_file.lower().endswith('.csv') else 'jsonl'
+
+	try:
+		if file_format == 'csv':
+
+			# increase CSV max size, abstracts can be long
+			csv.field_size_limit(sys.maxsize)
+
+			with open(export_file, 'rb') as f:
+				for row in csv.DictReader(f):
+					yield {key.decode('utf-8-sig') : value.decode('utf8') for key, value in row.items() if key is not None and value is not None}
+
+		elif file_format == 'jsonl':
+
+			with open(export_file, 'rb') as f:
+				for line in f:
+					if line.strip():
+						yield json.loads(line)
+		else:
+			logging.error('[{}] : unknown file format {}'.format(sys._getframe().f_code.co_name, file_format))
+			exit(1)
+
+	except Exception, e:
+		logging.error('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		exit(1)
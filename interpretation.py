@@ -97,20 +97,26 @@ class Interpretation():
 		# load LDA model according to parameters
 		model = load_lda_model(os.path.join(models_folder, str(K), dir_prior, str(random_state), str(num_pass), str(iteration)))
 		
-		# load docs
-		D = self.db.read_collection(collection = 'publications_raw')
+		# load docs, without their content
+		D = self.db.read_collection(collection = 'publications_raw', projection = {'journal' : 1, 'year' : 1, 'title' : 1, 'tokens' : 1, 'packed_tokens' : 1})
+
+		# vocabulary of packed tokens
+		id2token = load_token_vocabulary()
 
 		# loop through all the documents to infer document-topics distribition
 		for i, d in enumerate(D):
 
+			# tokens of the document, either as strings or packed
+			tokens = get_document_tokens(d, id2token)
+
 			# check if tokens are present; in case some documents couldn't properly be tokenized during pre-processing phase
-			if d.get('tokens') is not None:
+			if tokens is not None:
 
 				# print to console
 				print_doc_verbose(i, D.count(), d['journal'], d['year'], d['title'])
 
 				# create bag of words from tokens
-				bow = model.id2word.doc2bow(d['tokens'])
+				bow = model.id2word.doc2bow(tokens)
 
 				# infer document-topic distribution
 				topics = model.get_document_topics(bow, per_word_topics = False)
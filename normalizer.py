@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+	Created by:	Shaheen Syed
+	Date:		August 2018
+
+	Normalization of the plain text of converted PDF documents. The plain text of a PDF contains unicode dashes, ligatures, end-of-line hyphenation and
+	new lines, as well as boilerplate content, references and acknowledgements. The TextNormalizer class bundles this clean up into one reusable
+	component: a fixed, ordered character mapping, one compiled regular expression with all the boilerplate patterns of a source (e.g. a journal), 
+	and a cut at the last occurrence of the references and acknowledgement sections.
+
+	Note that the character mapping is done with consecutive replace calls and not with a single unicode translate table. Replace calls without a 
+	match do not copy the content and are close to a plain memory scan, whereas translate with a mapping table does a dictionary lookup per character 
+	and is several times slower (see the benchmark below).
+
+	The normalizer can be used on its own:
+
+		normalizer = TextNormalizer(boilerplate = {'NIPS' : [r'Advances in Neural Information Processing Systems \d+']})
+		content = normalizer.normalize(content, source = 'NIPS')
+
+	Run this file to benchmark the normalizer against the sequential clean up (python normalizer.py [plain text files])
+"""
+
+# packages and modules
+import logging, sys, re, timeit
+
+
+class TextNormalizer():
+
+	# dashes and ligatures that are mapped to plain characters
+	CHARACTER_MAP = {	u'\xad' : u'-',		# soft hyphen
+						u'\u2014' : u'-',	# em-dash
+						u'\u2013' : u'-',	# en-dash
+						u'\u2212' : u'-',	# minus sign
+						u'\ufb02' : u'fl',	# fl ligature
+						u'\ufb01' : u'fi',	# fi ligature
+						u'\ufb00' : u'ff',	# ff ligature
+						u'\ufb03' : u'ffi',	# ffi ligature
+						u'\ufb04' : u'ffl'}	# ffl ligature
+
+	def __init__(self, boilerplate = None, cut_sections = None, character_map = None):
+
+		"""
+			Parameters
+			----------
+			boilerplate : dictionary (optional)
+				list of regular expressions per source (e.g. journal) that match boilerplate content. Matches are removed from the content
+			cut_sections : list (optional)
+				section titles; the content is cut at the last occurrence of each of them, in order. Default is None, which removes references and 
+				acknowledgements
+			character_map : dictionary (optional)
+				characters that need to be replaced. Default is CHARACTER_MAP
+		"""
+
+		character_map = character_map or self.CHARACTER_MAP
+
+		# dashes are mapped first, so the hyphenation before a new line can be corrected for all of them
+		self.replacements = sorted(character_map.items(), key = lambda x: x[1] != u'-')
+
+		# a translate table with the same mapping, only used by the benchmark
+		self.translate_table = {ord(k) : v for k, v in character_map.items()}
+		self.translate_table[ord(u'\n')] = u' '
+
+		# one compiled regular expression per source
+		self.boilerplate = {}
+		for source, patterns in (boilerplate or {}).items():
+			self.add_boilerplate(source, patterns)
+
+		# a copy, so normalizers do not share the list of section titles
+		self.cut_sections = list(cut_sections) if cut_sections is not None else ['References', 'Acknowledgment']
+
+	def add_boilerplate(self, source, patterns):
+
+		"""
+			Add (or replace) the boilerplate regular expressions of a source
+
+			Parameters
+			----------
+			source : string
+				name of the source, e.g. journal
+			patterns : list of strings
+				regular expressions that match boilerplate content
+		"""
+
+		self.boilerplate[source] = re.compile(u'|'.join(u'(?:{})'.format(p) for p in patterns), re.UNICODE)
+
+	def normalize(self, content, source = None):
+
+		"""
+			Normalize the plain text of a converted PDF document
+			- correct for end-of-line hyphenation
+			- fix dashes and ligatures
+			- remove new lines/carriage returns
+			- remove boilerplate of the source
+			- remove references and acknowledgements
+
+			Parameters
+			----------
+			content : string
+				plain text of the PDF document
+			source : string (optional)
+				name of the source (e.g. journal) to remove the boilerplate of
+
+			Returns
+			-------
+			content : unicode
+				normalized content
+		"""
+
+		if isinstance(content, str):
+			content = content.decode('utf8')
+
+		# fix dashes and ligatures
+		for character, replacement in self.replacements:
+			content = content.replace(character, replacement)
+
+		# fix hyphenation that occur just before a new line and remove new lines/carriage returns
+		content = content.replace(u'-\n', u'').replace(u'\n', u' ')
+
+		# remove boilerplate content, which is specific for each journal
+		if source in self.boilerplate:
+			content = self.boilerplate[source].sub(u'', content)
+
+		# remove acknowledgements and/or references; this is a somewhat crude example
+		for section in self.cut_sections:
+			position = content.rfind(section)
+			if position > 0:
+				content = content[:position]
+
+		return content
+
+
+"""
+
+internal helper functions
+
+"""
+
+def sequential_normalize(content):
+
+	"""
+		Sequential clean up with one pass over the content per replacement; the reference for the benchmark
+	"""
+
+	content = content.replace(u'\xad', "-")
+	content = content.replace(u'\u2014', "-")
+	content = content.replace(u'\u2013', "-")
+	content = content.replace(u'\u2212', "-")
+	content = content.replace('-\n','')
+	content = content.replace('\n',' ')
+	content = content.replace(u'\ufb02', "fl")
+	content = content.replace(u'\ufb01', "fi")
+	content = content.replace(u'\ufb00', "ff")
+	content = content.replace(u'\ufb03', "ffi")
+	content = content.replace(u'\ufb04', "ffl")
+
+	if content.rfind("References") > 0:
+		content = content[:content.rfind("References")]
+	if content.rfind("Acknowledgment") > 0:
+		content = content[:content.rfind("Acknowledgment")]
+
+	return content
+
+
+def translate_normalize(normalizer, content):
+
+	"""
+		Clean up with a single translate table for the character mapping; the alternative that the TextNormalizer does not use
+	"""
+
+	content = content.replace(u'-\n', u'').translate(normalizer.translate_table)
+
+	for section in normalizer.cut_sections:
+		position = content.rfind(section)
+		if position > 0:
+			content = content[:position]
+
+	return content
+
+
+def benchmark(documents, repeat = 5):
+
+	"""
+		Compare the time per document of the TextNormalizer with the sequential clean up and with a translate table, and check they give the same output
+
+		Parameters
+		----------
+		documents : list of unicode
+			plain text documents
+		repeat : int (optional)
+			number of times each clean up is run over all documents; the fastest run is used
+
+		Returns
+		-------
+		timings : list of tuples
+			name of the clean up and the seconds it takes per document
+	"""
+
+	normalizer = TextNormalizer()
+
+	clean_ups = [	('sequential clean up', sequential_normalize), 
+					('TextNormalizer', normalizer.normalize),
+					('translate table', lambda x: translate_normalize(normalizer, x))]
+
+	# all clean ups should give the same result (the translate table is only equivalent for unicode dashes that are not followed by a new line)
+	for document in documents:
+		if sequential_normalize(document) != normalizer.normalize(document):
+			logging.warning('[{}] : normalizer output differs from sequential clean up'.format(sys._getframe().f_code.co_name))
+
+	return [(name, min(timeit.repeat(lambda: [clean_up(d) for d in documents], number = 1, repeat = repeat)) / len(documents)) for name, clean_up in clean_ups]
+
+
+if __name__ == "__main__":
+
+	# plain text documents from the command line, or a synthetic full-text document of a few hundred KB
+	if len(sys.argv) > 1:
+		documents = [open(f, 'rb').read().decode('utf8') for f in sys.argv[1:]]
+	else:
+		documents = [(u'The e\ufb03cient in\ufb02uence of hyper-\nparameters \u2014 a \ufb01rst study of\nlatent Dirichlet al\xad\nlocation. ' * 5000) +
+						u'Acknowledgment We thank the reviewers.\nReferences [1] Blei, D. M.\u2013 Ng, A. Y.']
+
+	for name, seconds in benchmark(documents):
+		print '{:<20}: {:.3f} ms per document'.format(name, seconds * 1000)
@@ -49,11 +49,27 @@
 
 # packages and modules
 import logging, sys, spacy
-from collections import Counter
-import itertools
+import itertools, multiprocessing
+from gensim.models.phrases import Phrases, Phraser
+from spacy.lang.en.stop_words import STOP_WORDS
+from spacy.tokens import Doc, DocBin
+from bson.objectid import ObjectId
 from database import MongoDatabase
+from normalizer import TextNormalizer
+from tokenizer import FastTokenizer
 from helper_functions import *
 
+# spacy natural language processing object and fast tokenizer of this process (see tokenize_documents)
+NLP = None
+FAST_TOKENIZER = None
+
+# version of the spacy model (see get_model_version)
+MODEL_VERSION = None
+
+# version of the token filters (word_tokenizer, named_entity_recognition and get_tokens); increase after changing them, so that
+# general_preprocessing tokenizes all documents again
+TOKENIZER_VERSION = 1
+
 
 class Preprocessing():
 
@@ -64,11 +80,15 @@ class Preprocessing():
 		# instantiate database
 		self.db = MongoDatabase()
 
+		# clean up of converted PDF documents; journal specific boilerplate can be added with self.normalizer.add_boilerplate
+		self.normalizer = TextNormalizer()
+
 		# set utf8 encoding
 		reload(sys)
 		sys.setdefaultencoding('utf8')
 
-	def full_text_preprocessing(self, pdf_folder = os.path.join('files', 'pdf')):
+	def full_text_preprocessing(self, pdf_folder = os.path.join('files', 'pdf'), n_workers = 1, timeout = 300, batch_size = 100, 
+								cache_folder = os.path.join('files', 'cache', 'text'), max_cache_size = 10 * 1024 ** 3, queue = None):
 
 
 		"""
@@ -84,6 +104,21 @@ class Preprocessing():
 			----------
 			pdf_folder : os.path
 				location where PDF documents are stored
+			n_workers : int (optional)
+				number of processes that convert PDF documents to plain text in parallel. Default is 1 (no parallel conversion)
+			timeout : int (optional)
+				maximum number of seconds the conversion of a single PDF document may take, after which the document is skipped
+			batch_size : int (optional)
+				number of documents saved to the database at once
+			cache_folder : os.path (optional)
+				location of the cache with the plain text of converted PDF documents. When the clean up rules change, run reclean_full_text to clean the 
+				stored documents again from the cache, without converting any PDF. Set to None to disable
+			max_cache_size : int (optional)
+				maximum size of the text cache in bytes. Least recently used texts are removed when the cache is larger
+			queue : WorkQueue (optional)
+				work queue to share the PDF documents with other processes or machines (that read the same pdf_folder), e.g. WorkQueue('full_text'). 
+				Documents are then claimed in batches of batch_size, and documents that can not be converted are released for another attempt. 
+				Default is None (this process converts all documents)
 		"""
 		
 		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
@@ -91,127 +126,415 @@ class Preprocessing():
 		# read pdf files that need to be converted
 		F = [x for x in read_directory(pdf_folder) if x[-4:] == '.pdf']
 
-		# read documents from DB that have already been processed so we can skip them
-		processed_documents = [ '{}-{}-{}'.format(x['journal'], x['year'], x['title']) for x in self.db.read_collection(collection = 'publications_raw')]
+		# make sure a publication can only be stored once
+		self.db.create_unique_index(collection = 'publications_raw', keys = ['journal', 'year', 'title'])
 
-		# loop over each file and convert pdf to plain and save meta data to DB
-		for i, f in enumerate(F):
+		# read documents from DB that have already been processed so we can skip them; only the fields of the key are read
+		processed_documents = set('{}-{}-{}'.format(x['journal'], x['year'], x['title']) for x in 
+									self.db.read_collection(collection = 'publications_raw', projection = {'journal' : 1, 'year' : 1, 'title' : 1, '_id' : 0}))
 
-			# extract meta data from folder structure and file name
-			journal = f.split('/')[2]
-			year = f.split('/')[3]
-			title = f.split('/')[4].replace('-', ' ')[4:-4].strip()
+		# collect the files that still need to be converted
+		tasks = []
+		for f in F:
 
-			# console output
-			print_doc_verbose(i, len(F), journal, year, title)
+			# extract meta data from folder structure and file name
+			task = get_pdf_task(f)
 
 			# check if PDF has already been processed
-			if '{}-{}-{}'.format(journal, year, title) in processed_documents:
+			if '{}-{}-{}'.format(*task[1:]) in processed_documents:
 				logging.info('PDF document already processed, skipping ...')
 				continue
 
-			# convert content of PDF to plain text
-			content = pdf_to_plain(f)
-
-			# check if content could be extracted
-			if content is not None:
-				
-				# fix soft hyphen
-				content = content.replace(u'\xad', "-")
-				# fix em-dash
-				content = content.replace(u'\u2014', "-")
-				# fix en-dash
-				content = content.replace(u'\u2013', "-")
-				# minus sign
-				content = content.replace(u'\u2212', "-")
-				# fix hyphenation that occur just before a new line
-				content = content.replace('-\n','')
-				# remove new lines/carriage returns
-				content = content.replace('\n',' ')
-
-				# correct for ligatures
-				content = content.replace(u'\ufb02', "fl")	# fl ligature
-				content = content.replace(u'\ufb01', "fi")	# fi ligature
-				content = content.replace(u'\ufb00', "ff")	# ff ligature
-				content = content.replace(u'\ufb03', "ffi") # ffi ligature
-				content = content.replace(u'\ufb04', "ffl") # ffl ligature
-
-				""" 
-					Remove boilerplate content:
-
-					Especially journal publications have lots of boilerplate content on the titlepage. Removing of this is specific for each
-					journal and you can use some regular expressions to identify and remove it.
-				"""
-
-				"""
-					Remove acknowledgemends and/or references
-					This is a somewhat crude example
-				"""
-				if content.rfind("References") > 0:
-					content = content[:content.rfind("References")]
-			
-				"""
-				 	Remove acknowledgements
-				"""
-				if content.rfind("Acknowledgment") > 0:
-					content = content[:content.rfind("Acknowledgment")]
-			
-				# prepare dictionary to save into MongoDB
-				doc = {	'journal' : journal, 'title' : title, 'year' : year, 'content' : content}
+			tasks.append(task)
+
+		# without a work queue all files are converted by this process; with a work queue the files are claimed in batches, and the other
+		# processes claim the rest. A batch is marked as done after it has been saved to the database
+		if queue is None:
+			task_batches = [tasks]
+		else:
+			queue.add(t[0] for t in tasks)
+			task_batches = ([get_pdf_task(f) for f in keys] for keys in queue.claim_batches(batch_size))
+
+		# convert the PDF documents, either one by one or by a pool of processes
+		pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+
+		batch, cache_hits, i = [], 0, 0
+		for task_batch in task_batches:
+
+			conversions = [(t[0], timeout, cache_folder) for t in task_batch]
+			contents = pool.imap(convert_pdf, conversions) if pool is not None else itertools.imap(convert_pdf, conversions)
+
+			# loop over each converted file and save content and meta data to DB in batches
+			for (f, journal, year, title), (content, cache_hit) in itertools.izip(task_batch, contents):
+
+				cache_hits += cache_hit
+
+				# console output
+				print_doc_verbose(i, len(tasks), journal, year, title)
+				i += 1
+
+				# check if content could be extracted
+				if content is not None:
+					
+					# fix hyphenation, dashes and ligatures, remove new lines, boilerplate, references and acknowledgements
+					content = self.normalizer.normalize(content, source = journal)
+
+					# prepare dictionary to save into MongoDB
+					batch.append({	'journal' : journal, 'title' : title, 'year' : year, 'content' : content, 'content_hash' : get_content_hash(content)})
+
+				elif queue is not None:
+					queue.fail([f], error = 'conversion failed')
 
 				# save to database
-				self.db.insert_one_to_collection(doc = doc, collection = 'publications_raw')
+				if len(batch) >= batch_size:
+					self.db.insert_many_to_collection(docs = batch, collection = 'publications_raw', ignore_duplicates = True)
+					batch = []
+
+			# save the remaining documents
+			self.db.insert_many_to_collection(docs = batch, collection = 'publications_raw', ignore_duplicates = True)
+			batch = []
+
+		if pool is not None:
+			pool.close()
+			pool.join()
 
-	def general_preprocessing(self, min_bigram_count = 5):
+		if cache_folder is not None:
+			logging.info('Text cache: {} hits, {} misses ({:.1%} hit rate)'.format(cache_hits, i - cache_hits, float(cache_hits) / max(i, 1)))
+			logging.info('Text cache: evicted {} texts'.format(evict_text_cache(cache_folder, max_cache_size)))
+
+	def reclean_full_text(self, pdf_folder = os.path.join('files', 'pdf'), cache_folder = os.path.join('files', 'cache', 'text'), batch_size = 100):
+
+		"""
+			Clean the stored full-text publications again with the current clean up rules (self.normalizer), as a pure text pass: the plain text of 
+			each PDF document is read from the text cache, normalized, and the content and content_hash of the stored document are updated if they 
+			changed. No PDF is converted; documents without cached text are skipped. The tokens of updated documents become stale (their content_hash 
+			changes), so general_preprocessing tokenizes them again
+
+			Parameters
+			----------
+			pdf_folder : os.path
+				location where PDF documents are stored
+			cache_folder : os.path (optional)
+				location of the cache with the plain text of converted PDF documents (see full_text_preprocessing)
+			batch_size : int (optional)
+				number of documents read from and saved to the database at once
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# read pdf files of which the stored documents are cleaned again
+		F = [x for x in read_directory(pdf_folder) if x[-4:] == '.pdf']
+
+		num_updated, num_unchanged, num_skipped = 0, 0, 0
+		for tasks in get_batches((get_pdf_task(f) for f in F), batch_size):
+
+			# stored documents of the batch, by journal, year and title
+			D = self.db.read_collection(collection = 'publications_raw', query = {'$or' : [{'journal' : t[1], 'year' : t[2], 'title' : t[3]} for t in tasks]}, 
+										projection = {'journal' : 1, 'year' : 1, 'title' : 1, 'content_hash' : 1})
+			stored = {(d['journal'], d['year'], d['title']) : d for d in D}
+
+			updates = []
+			for f, journal, year, title in tasks:
+
+				d = stored.get((journal, year, title))
+				content = read_text_cache(f, cache_folder) if d is not None else None
+
+				# documents that were never stored, or of which the plain text is not cached
+				if content is None:
+					num_skipped += 1
+					continue
+
+				# fix hyphenation, dashes and ligatures, remove new lines, boilerplate, references and acknowledgements
+				content = self.normalizer.normalize(content, source = journal)
+				content_hash = get_content_hash(content)
+
+				if content_hash == d.get('content_hash'):
+					num_unchanged += 1
+					continue
+
+				updates.append((d['_id'], {'content' : content, 'content_hash' : content_hash}))
+
+			# save the cleaned content to the database
+			self.db.update_fields_in_collection(collection = 'publications_raw', updates = updates)
+			num_updated += len(updates)
+
+		logging.info('Cleaned {} documents again, {} unchanged, {} skipped'.format(num_updated, num_unchanged, num_skipped))
+
+	def general_preprocessing(self, min_bigram_count = 5, n_workers = 1, batch_size = 100, analysis_cache_folder = os.path.join('files', 'cache', 'spacy'), engine = 'spacy', 
+								queue = None, max_chunk_length = 100000):
 
 		"""
 			General preprocessing of publications (used for abstracts and full-text)
 
+			Documents are send through spaCy in batches (nlp.pipe), with the dependency parser disabled since only lemmas, stop words and entities 
+			are used. With more than one worker, the batches are divided over a pool of processes that each load their own spaCy model. Long documents
+			(e.g. theses) are split into chunks of at most max_chunk_length characters, which are processed one after the other and merged into the tokens
+			of the document. This bounds the peak memory of spaCy by the length of a chunk; the tokens and the cached analysis (if any) of all chunks of a 
+			document are still kept until the document is done, so memory does grow with the size of a document, only much less steeply.
+
 			Parameters
 			----------
 			min_bigram_count : int (optional)
 				frequency of bigram to occur to include into list of bigrams. Thus lower frequency than min_bigram_count will not be included.
+				Set to None to skip the bigrams within documents, and detect them over the full corpus with detect_phrases instead
+			n_workers : int (optional)
+				number of processes that tokenize documents in parallel. Default is 1 (no parallel processing)
+			batch_size : int (optional)
+				number of documents each process tokenizes at once
+			analysis_cache_folder : os.path (optional)
+				location to save the spacy analysis of each document to, so refilter_tokens can create the tokens again without running spacy. 
+				Set to None to disable
+			engine : string (optional)
+				'spacy' for the full spacy pipeline, or 'fast' for the lightweight FastTokenizer (regular expression tokenizer and lookup table 
+				lemmatizer, without named entity recognition), which is suitable for clean text such as abstracts
+			queue : WorkQueue (optional)
+				work queue to share the documents with other processes or machines, e.g. WorkQueue('general_preprocessing'). Documents are then 
+				claimed in batches of batch_size * n_workers. Default is None (this process tokenizes all documents)
+			max_chunk_length : int (optional)
+				maximum number of characters spaCy processes at once; longer documents are split at paragraph or sentence boundaries. Must be smaller 
+				than the max_length of spaCy
 		"""
 
 		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
 
-		# read document collection
-		D = self.db.read_collection(collection = 'publications_raw')
+		# fingerprint of the preprocessing configuration
+		config_fingerprint = get_config_fingerprint(min_bigram_count, engine)
+
+		# read only the documents that need to be tokenized, and only the fields that are needed
+		projection = {'journal' : 1, 'year' : 1, 'title' : 1, 'content' : 1, 'content_hash' : 1}
+		D = self.db.read_collection(collection = 'publications_raw', query = get_stale_tokens_query(config_fingerprint), projection = projection)
+
+		# number of documents to tokenize
+		total = D.count()
 
-		# setup spacy natural language processing object
-		nlp = setup_spacy()
+		# without a work queue all documents are tokenized by this process; with a work queue the documents are claimed in batches, and the
+		# other processes claim the rest. The keys contain the fingerprint, so a new configuration gets new work items
+		if queue is None:
+			doc_batches = get_batches(D, batch_size * n_workers)
+		else:
+			queue.add('{}-{}'.format(config_fingerprint, d['_id']) for d in 
+						self.db.read_collection(collection = 'publications_raw', query = get_stale_tokens_query(config_fingerprint), projection = {'_id' : 1}))
+			doc_batches = (list(self.db.read_collection(collection = 'publications_raw', query = {'_id' : {'$in' : [ObjectId(k.split('-')[-1]) for k in keys]}}, 
+						projection = projection)) for keys in queue.claim_batches(batch_size * n_workers))
 
-		# loop through the documents and correct content
-		for i, d in enumerate(D):
+		# pool of processes that run spacy; each loads the spacy model when it receives its first batch
+		pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
 
-			# check if tokens are already present, if so, skip
-			if d.get('tokens') is None:
+		# read as many documents as the workers can process at once
+		i = 0
+		for docs in doc_batches:
+
+			# documents inserted before content hashes existed get one now
+			for d in docs:
+				d['content_hash'] = d.get('content_hash') or get_content_hash(d['content'])
+
+			# divide the documents in batches, one for each worker
+			tasks = [([d['content'] for d in batch], [d['content_hash'] for d in batch], min_bigram_count, analysis_cache_folder, engine, max_chunk_length) 
+						for batch in get_batches(docs, batch_size)]
+
+			# tokenize, either in this process or in the pool of processes
+			fields = itertools.chain(*(pool.map(tokenize_documents, tasks) if pool is not None else map(tokenize_documents, tasks)))
+
+			updates = []
+			for d, f in itertools.izip(docs, fields):
 
 				# print to console
-				print_doc_verbose(i, D.count(), d['journal'], d['year'], d['title'])
+				print_doc_verbose(i, total, d['journal'], d['year'], d['title'])
+				i += 1
+
+				# record the fingerprint and engine of the tokens
+				f['content_hash'] = f['tokens_content_hash'] = d['content_hash']
+				f['tokens_config'] = config_fingerprint
+				f['tokens_engine'] = engine
+
+				updates.append((d['_id'], f))
+
+			# save tokens to database; tokens_seq records the batch in which a document was first tokenized (see Transformation.append_for_lda)
+			self.db.update_fields_in_collection(collection = 'publications_raw', updates = updates, sequence_field = 'tokens_seq')
+
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+
+
+	def refilter_tokens(self, min_bigram_count = 5, batch_size = 1000, analysis_cache_folder = os.path.join('files', 'cache', 'spacy')):
+
+		"""
+			Create the tokens again from the cached spacy analyses (see general_preprocessing), without running spacy. Use this after changing the
+			token filters (word_tokenizer, named_entity_recognition, stop words or the minimum bigram count). Only documents with a stale fingerprint are
+			updated; documents without a cached analysis are skipped and left for general_preprocessing.
+
+			Each document keeps the engine it was tokenized with (tokens_engine). Documents tokenized with the fast engine have no spacy analysis; they are 
+			tokenized again with the FastTokenizer, which is cheap.
+
+			Parameters
+			----------
+			min_bigram_count : int (optional)
+				frequency of bigram to occur to include into list of bigrams. Set to None to skip the bigrams within documents
+			batch_size : int (optional)
+				number of documents updated in the database at once
+			analysis_cache_folder : os.path (optional)
+				location of the cached spacy analyses
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# only the vocabulary of spacy is needed (for the stop words and lexical attributes), none of the pipeline components
+		nlp = setup_spacy(disable = ['tagger', 'parser', 'ner'])
+		fast_tokenizer = None
 
-				# get content from document and convert to spacy object
-				content = nlp(d['content'])
+		num_refiltered, num_skipped = 0, 0
+		for engine in ['spacy', 'fast']:
+
+			# fingerprint of the preprocessing configuration of the engine
+			config_fingerprint = get_config_fingerprint(min_bigram_count, engine)
+
+			# documents tokenized before the engine was recorded were tokenized with spacy
+			query = {'$and' : [get_stale_tokens_query(config_fingerprint), {'tokens_engine' : {'$in' : [engine, None]} if engine == 'spacy' else engine}]}
+
+			# read documents that need to be tokenized again; only the fast tokenizer needs their content
+			projection = {'content_hash' : 1, 'content' : 1} if engine == 'fast' else {'content_hash' : 1}
+			D = self.db.read_collection(collection = 'publications_raw', query = query, projection = projection)
+
+			for docs in get_batches(D, batch_size):
+
+				updates = []
+				for d in docs:
+
+					if engine == 'fast':
+						fast_tokenizer = fast_tokenizer or FastTokenizer(get_stop_words())
+						d['content_hash'] = d.get('content_hash') or get_content_hash(d['content'])
+						f = fast_tokenizer.tokenize(d['content'], min_bigram_count)
+					else:
+						# load the cached analysis of the document
+						content = load_analysis(get_analysis_file(analysis_cache_folder, d['content_hash']), nlp.vocab) if d.get('content_hash') else None
+
+						if content is None:
+							num_skipped += 1
+							continue
+
+						f = get_tokens(content, min_bigram_count)
+
+					# record the fingerprint and engine of the tokens
+					f['content_hash'] = f['tokens_content_hash'] = d['content_hash']
+					f['tokens_config'] = config_fingerprint
+					f['tokens_engine'] = engine
+
+					updates.append((d['_id'], f))
+
+				# save tokens to database; documents tokenized for the first time get a tokens_seq, like in general_preprocessing
+				self.db.update_fields_in_collection(collection = 'publications_raw', updates = updates, sequence_field = 'tokens_seq')
+				num_refiltered += len(updates)
+
+		logging.info('Refiltered {} documents, skipped {} documents without cached analysis'.format(num_refiltered, num_skipped))
+
+	def detect_phrases(self, min_count = 5, threshold = 10.0, max_vocab_size = 40000000, batch_size = 1000, save_folder = os.path.join('files', 'lda')):
+
+		"""
+			Detect phrases (bigrams) over the full corpus, instead of within each document. Words that often occur next to each other in the corpus 
+			are detected as a phrase, also when the phrase occurs only once or twice within a single document. Run after general_preprocessing with
+			min_bigram_count = None.
+
+			The corpus is streamed from the database twice: the first pass counts the words and word pairs, the second pass adds the phrases found in 
+			each document to its tokens. The counts are kept in a table that is pruned of its least frequent entries whenever it grows beyond 
+			max_vocab_size, so memory use does not grow with the size of the corpus.
+
+			Parameters
+			----------
+			min_count : int (optional)
+				ignore words and word pairs with a lower total count in the corpus
+			threshold : float (optional)
+				minimum score of a word pair to be a phrase; higher means fewer phrases
+			max_vocab_size : int (optional)
+				maximum number of words and word pairs to keep counts of (roughly 1GB of RAM per 10 million)
+			batch_size : int (optional)
+				number of documents updated in the database at once
+			save_folder : os.path (optional)
+				location to save the phrase model to
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
 
-				# tokenize, lemmatization, remove punctuation, remove single character words
-				unigrams = word_tokenizer(content)
+		# only documents that contain the number of unigrams and entities can be split into unigrams, bigrams and entities
+		query = {'num_unigrams' : {'$exists' : True}}
+		projection = {'tokens' : 1, 'packed_tokens' : 1, 'num_unigrams' : 1, 'num_entities' : 1}
 
-				# get entities
-				entities = named_entity_recognition(content)
+		# vocabulary of packed tokens
+		id2token = load_token_vocabulary()
 
-				# get bigrams
-				bigrams = get_bigrams(" ".join(unigrams))
-				bigrams = [['{} {}'.format(x[0],x[1])] * y for x, y in Counter(bigrams).most_common() if y >= min_bigram_count]
-				bigrams = list(itertools.chain(*bigrams))
+		# first pass: learn the phrases from the unigrams of all documents
+		D = self.db.read_collection(collection = 'publications_raw', query = query, projection = projection)
+		phrases = Phrases((get_document_tokens(d, id2token)[:d['num_unigrams']] for d in D), min_count = min_count, threshold = threshold, max_vocab_size = max_vocab_size, delimiter = ' ')
 
-				d['tokens'] = unigrams + bigrams + entities
+		# keep only the learned phrases, not the counts
+		phraser = Phraser(phrases)
+		create_directory(save_folder)
+		phraser.save(os.path.join(save_folder, 'phrases.model'))
 
-				# save dictionary to datbase
-				self.db.update_collection(collection = 'publications_raw', doc = d)
+		logging.info('Detected {} phrases'.format(len(phraser.phrasegrams)))
 
-				
-			else:
-				logging.debug('Document already tokenized, skipping ...')
+		# second pass: replace the bigrams of each document with the detected phrases
+		D = self.db.read_collection(collection = 'publications_raw', query = query, projection = projection)
+		for docs in get_batches(D, batch_size):
+
+			updates = []
+			for d in docs:
+
+				tokens = get_document_tokens(d, id2token)
+				unigrams = tokens[:d['num_unigrams']]
+				entities = tokens[len(tokens) - d['num_entities']:]
+
+				# phrases within the document; the unigrams are kept as well, similar to the bigrams within documents
+				bigrams = [x for x in phraser[unigrams] if ' ' in x]
+
+				updates.append((d['_id'], {'tokens' : unigrams + bigrams + entities}))
+
+			# save tokens to database
+			self.db.update_fields_in_collection(collection = 'publications_raw', updates = updates)
+
+
+
+	def pack_tokens(self, vocabulary_folder = os.path.join('files', 'tokens'), batch_size = 1000):
+
+		"""
+			Store the tokens of each document in a compact form: the integer id of each token in a corpus-level vocabulary, packed into a binary 
+			array of 32 bit integers (packed_tokens). The list of token strings is removed from the document. This shrinks the storage and the transfer 
+			volume of the tokens several-fold; the transformation, evaluation and interpretation phases decode the packed tokens when reading them.
+
+			Only documents with a tokens field are packed, so this can be run again after new documents have been tokenized. The vocabulary is 
+			append-only: new tokens get the next free id and existing ids never change.
+
+			Parameters
+			----------
+			vocabulary_folder : os.path (optional)
+				location of the vocabulary file
+			batch_size : int (optional)
+				number of documents updated in the database at once
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# load the vocabulary of earlier runs
+		id2token = load_token_vocabulary(vocabulary_folder)
+		token2id = {token : i for i, token in enumerate(id2token)}
+
+		# read only documents with token strings
+		D = self.db.read_collection(collection = 'publications_raw', query = {'tokens' : {'$exists' : True}}, projection = {'tokens' : 1})
+
+		for docs in get_batches(D, batch_size):
+
+			# pack the tokens of each document
+			vocabulary_size = len(id2token)
+			updates = [(d['_id'], encode_tokens(d['tokens'], token2id, id2token)) for d in docs]
+
+			# save new tokens to the vocabulary before the documents refer to them
+			save_token_vocabulary(id2token, start = vocabulary_size, folder = vocabulary_folder)
+
+			# replace the token strings by the packed tokens
+			self.db.replace_fields_in_collection(collection = 'publications_raw', updates = updates, set_field = 'packed_tokens', unset_field = 'tokens')
+
+		logging.info('Vocabulary size of packed tokens: {}'.format(len(id2token)))
 
 
 
@@ -229,21 +552,248 @@ def print_doc_verbose(i, total, journal, year, title):
 	logging.debug('year : {}'.format(year))
 	logging.debug('title : {}'.format(title))
 
-def setup_spacy():
+def get_pdf_task(f):
+
+	"""
+		Return the location, journal, year and title of a PDF document; the meta data is extracted from the folder structure and file name
+	"""
+
+	return (f, f.split('/')[2], f.split('/')[3], f.split('/')[4].replace('-', ' ')[4:-4].strip())
+
+def convert_pdf(task):
+
+	"""
+		Convert PDF file to plain text within a time limit. Used by the (parallel) conversion in full_text_preprocessing, so it needs to be
+		a module-level function
+
+		Parameters
+		----------
+		task : tuple
+			location of the pdf file, the maximum number of seconds the conversion may take and the location of the text cache (None for no cache)
+
+		Returns
+		-------
+		plain_pdf : string
+			plain text version of the PDF file, or None if the conversion failed or timed out
+		cache_hit : Boolean
+			True if the plain text was read from the text cache
+	"""
+
+	pdf_file, timeout, cache_folder = task
+
+	# the conversion process is killed when it takes longer than the time limit
+	timeout = timeout or None
+
+	if cache_folder is None:
+		return pdf_to_plain(pdf_file, timeout), False
+	return cached_pdf_to_plain(pdf_file, cache_folder, timeout)
+
+def tokenize_documents(task):
+
+	"""
+		Tokenize a batch of documents with spacy (lemmatized unigrams, bigrams and entities) or with the FastTokenizer. Used by the (parallel) tokenization in general_preprocessing, 
+		so it needs to be a module-level function
+
+		Parameters
+		----------
+		task : tuple
+			list with the content of each document, list with the content hash of each document, the minimum bigram count, the location of 
+			the analysis cache (None for no cache), the tokenization engine ('spacy' or 'fast') and the maximum number of characters spacy processes at once
+
+		Returns
+		-------
+		fields : list of dictionaries
+			tokens of each document, together with the number of unigrams and entities (see get_tokens)
+	"""
+
+	contents, content_hashes, min_bigram_count, analysis_cache_folder, engine, max_chunk_length = task
+
+	# tokenize with the fast tokenizer; created once per process
+	if engine == 'fast':
+		global FAST_TOKENIZER
+		if FAST_TOKENIZER is None:
+			FAST_TOKENIZER = FastTokenizer(get_stop_words())
+		return [FAST_TOKENIZER.tokenize(content, min_bigram_count) for content in contents]
+
+	# setup spacy natural language processing object once per process; the dependency parser is not used
+	global NLP
+	if NLP is None:
+		NLP = setup_spacy(disable = ['parser'])
+
+	# split long documents into chunks; each chunk is labeled with the index of its document
+	chunks = ((chunk, i) for i, content in enumerate(contents) for chunk in split_content(content, max_chunk_length))
+
+	# the chunks are streamed through spacy and grouped by document again; every document has at least one chunk
+	documents = itertools.groupby(NLP.pipe(chunks, as_tuples = True, batch_size = len(contents)), key = lambda x: x[1])
+
+	fields = []
+	for content_hash, (_, content) in itertools.izip(content_hashes, documents):
+
+		content = (chunk for chunk, _ in content)
 
-	# setting up spacy
-	nlp = spacy.load('en')
+		# save the spacy analysis, so the tokens can be created again without running spacy
+		if analysis_cache_folder is not None:
+			doc_bin = DocBin(attrs = ['LEMMA', 'ENT_IOB', 'ENT_TYPE'])
+			content = add_to_analysis(content, doc_bin)
+
+		fields.append(get_tokens(content, min_bigram_count))
+
+		if analysis_cache_folder is not None:
+			save_analysis(doc_bin, get_analysis_file(analysis_cache_folder, content_hash))
+
+	return fields
+
+def get_analysis_file(analysis_cache_folder, content_hash):
+
+	"""
+		Return the location of the cached spacy analysis of a document; the analysis depends on the content and on the spacy version
+	"""
+
+	return os.path.join(analysis_cache_folder, spacy.__version__, content_hash[0:2], content_hash + '.spacy')
+
+def add_to_analysis(chunks, doc_bin):
+
+	"""
+		Add each spacy document (chunk) to the analysis while it passes through, so the chunks do not need to be kept in memory
+	"""
+
+	for chunk in chunks:
+		doc_bin.add(chunk)
+		yield chunk
+
+def save_analysis(doc_bin, analysis_file):
+
+	"""
+		Save the spacy analysis of a document in compact binary form: the words of each chunk with their lemma and entity annotations
+	"""
+
+	try:
+		create_directory(os.path.dirname(analysis_file))
+
+		# write to a temporary file first, so a killed run does not leave a broken analysis
+		with open(analysis_file + '.tmp', 'wb') as f:
+			f.write(doc_bin.to_bytes())
+		os.rename(analysis_file + '.tmp', analysis_file)
+	except Exception, e:
+		logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+
+def load_analysis(analysis_file, vocab):
+
+	"""
+		Load the cached spacy analysis of a document as a list of spacy documents (one per chunk), or None if the document has not been analysed 
+		(with this spacy version and content)
+	"""
+
+	if not os.path.exists(analysis_file):
+		return None
+
+	try:
+		with open(analysis_file, 'rb') as f:
+			return list(DocBin().from_bytes(f.read()).get_docs(vocab))
+	except Exception, e:
+		logging.warning('[{}] : {}'.format(sys._getframe().f_code.co_name,e))
+		return None
+
+def get_tokens(content, min_bigram_count):
+
+	"""
+		Get the unigrams, bigrams and entities of a spacy document
+
+		Parameters
+		----------
+		content : spacy document, or iterable of spacy documents
+			processed document, or the processed chunks of a long document. The unigrams and entities of the chunks are merged before the bigrams are counted
+		min_bigram_count : int
+			frequency of bigram to occur to include into list of bigrams. None for no bigrams (e.g. when they are detected corpus wide by detect_phrases)
+
+		Returns
+		-------
+		fields : dictionary
+			tokens (unigrams, bigrams and entities), and the number of unigrams and entities so they can be separated again by detect_phrases
+	"""
+
+	unigrams, entities = [], []
+	for chunk in ([content] if isinstance(content, Doc) else content):
+
+		# tokenize, lemmatization, remove punctuation, remove single character words
+		unigrams.extend(word_tokenizer(chunk))
+
+		# get entities
+		entities.extend(named_entity_recognition(chunk))
+
+	# get bigrams
+	bigrams = get_document_bigrams(unigrams, min_bigram_count) if min_bigram_count is not None else []
+
+	return {'tokens' : unigrams + bigrams + entities, 'num_unigrams' : len(unigrams), 'num_entities' : len(entities)}
+
+def get_stop_words():
+
+	"""
+		Return the stop words: the spacy stop words, extended with the nltk stop words; apparently spacy does not contain all the stopwords
+	"""
+
+	stop_words = set(STOP_WORDS)
 
-	# add some more stopwords; apparently spacy does not contain all the stopwords
 	for word in set(stopwords.words('english')):
 
-		nlp.Defaults.stop_words.add(unicode(word))
-		nlp.Defaults.stop_words.add(unicode(word.title()))
+		stop_words.add(unicode(word))
+		stop_words.add(unicode(word.title()))
+
+	return stop_words
+
+def get_stale_tokens_query(config_fingerprint):
+
+	"""
+		Return the database query for documents that need to be (re-)tokenized. Each tokenized document stores the fingerprint of the configuration 
+		and the hash of the content its tokens were created with. Documents that are not tokenized yet, or of which the fingerprint is stale, match
+		the query. Documents tokenized before fingerprints existed have no fingerprint and are stale as well, since it is unknown which configuration 
+		their tokens were created with.
+	"""
+
+	return {'$or' : [	{'tokens' : {'$exists' : False}, 'packed_tokens' : {'$exists' : False}},
+						{'tokens_config' : {'$ne' : config_fingerprint}},
+						{'$expr' : {'$ne' : ['$tokens_content_hash', '$content_hash']}}]}
+
+def get_config_fingerprint(min_bigram_count, engine = 'spacy'):
+
+	"""
+		Return the fingerprint of the configuration of general_preprocessing: the version of the token filters, the tokenization engine, the spacy 
+		version, the version of the spacy model (which creates the lemmas and entities), the stop words and the minimum bigram count. A change in any 
+		of them changes the fingerprint, so documents are tokenized again
+	"""
+
+	config = {	'version' : TOKENIZER_VERSION,
+				'engine' : engine,
+				'spacy' : spacy.__version__,
+				'model' : get_model_version() if engine == 'spacy' else None,
+				'stop_words' : sorted(get_stop_words()),
+				'min_bigram_count' : min_bigram_count}
+
+	return hashlib.sha1(json.dumps(config, sort_keys = True)).hexdigest()
+
+def get_model_version():
+
+	"""
+		Return the version of the spacy model; the model is loaded (without pipeline components) only once per process
+	"""
+
+	global MODEL_VERSION
+	if MODEL_VERSION is None:
+		MODEL_VERSION = spacy.load('en', disable = ['tagger', 'parser', 'ner']).meta['version']
+
+	return MODEL_VERSION
+
+def setup_spacy(disable = None):
+
+	# setting up spacy, without the pipeline components that are disabled
+	nlp = spacy.load('en', disable = list(disable or []))
+
+	# add some more stopwords
+	for word in get_stop_words():
 
-	for word in nlp.Defaults.stop_words:
+		nlp.Defaults.stop_words.add(word)
 		lex = nlp.vocab[word]
 		lex.is_stop = True
 	
 	return nlp
 
-			
\ No newline at end of file
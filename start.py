@@ -35,6 +35,7 @@ from datamining import Datamining
 from evaluation import Evaluation
 from interpretation import Interpretation
 from helper_functions import *
+from database import WorkQueue
 
 import logging
 from datetime import datetime
@@ -82,6 +83,10 @@ if __name__ == "__main__":
 		# extract publications from NIPS website
 		extraction.extract_publications()
 
+		# # ingest publications (e.g. abstracts) from a Scopus or Web of Science export
+		# extraction.ingest_publications(export_file = os.path.join('files', 'export', 'scopus.csv'), 
+		# 								field_map = {'journal' : 'Source title', 'year' : 'Year', 'title' : 'Title', 'content' : 'Abstract'})
+
 
 	if PREPROCESSING:
 
@@ -130,6 +135,18 @@ if __name__ == "__main__":
 		# preprocessing general
 		preprocessing.general_preprocessing()
 
+		# # for large corpora: skip the bigrams within documents and detect phrases over the full corpus
+		# preprocessing.general_preprocessing(min_bigram_count = None)
+		# preprocessing.detect_phrases()
+
+		# # to share the work with other processes or machines: start this script on each of them with a work queue
+		# preprocessing.full_text_preprocessing(queue = WorkQueue('full_text'))
+		# preprocessing.general_preprocessing(queue = WorkQueue('general_preprocessing'))
+
+		# # after a change of the clean up rules: clean the stored full-text articles again from the text cache, and tokenize the changed ones
+		# preprocessing.reclean_full_text()
+		# preprocessing.general_preprocessing()
+
 
 	if TRANSFORMATION:
 		
@@ -154,6 +171,24 @@ if __name__ == "__main__":
 		# transform data to make it suitable for LDA analysis
 		transformation.transform_for_lda()
 
+		# # for large corpora: stream the tokens instead of keeping them in memory
+		# transformation.transform_for_lda(streaming = True, token_file = os.path.join('files', 'lda', 'tokens.jsonl'))
+
+		# # save the corpus in binary form, which is opened memory-mapped by all LDA runs instead of parsed from text
+		# transformation.transform_for_lda(corpus_format = 'binary')
+
+		# # only add the documents that were added since the last transformation
+		# transformation.transform_for_lda(append = True)
+
+		# # for very large vocabularies: hash the tokens into a fixed number of buckets
+		# transformation.transform_for_lda(streaming = True, num_buckets = 2 ** 20)
+
+		# # prune the corpus further without reading the tokens again, e.g. with domain-specific stop words found in the evaluation phase
+		# transformation.prune_corpus(tfidf_quantile = 0.05, stop_words = ['fish', 'study'])
+
+		# # compare the vocabulary size, non-zeros and coverage of a grid of no_below and no_above thresholds (files/tables/threshold-sweep.csv)
+		# transformation.threshold_sweep()
+
 
 	if DATAMINING:
 
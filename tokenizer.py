@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+	Created by:	Shaheen Syed
+	Date:		August 2018
+
+	Lightweight tokenizer for clean text, such as abstracts. Abstract data usually comes in a clean format of around 300--400 words, for which running
+	the full spacy model (tagger and named entity recognizer) is overkill. The FastTokenizer splits text into words with a compiled regular expression,
+	removes the same stop words as the spacy pipeline (spacy + nltk), and lemmatizes words with a lookup table (memoized per word). Named entity
+	recognition is skipped. The tokens are compatible with the tokens field created by the spacy pipeline: lemmatized unigrams followed by the bigrams
+	that occur at least min_bigram_count times within the document.
+
+	Since the lookup table does not take the part-of-speech of a word into account, lemmas can differ from the spacy pipeline for some words. Run this
+	file to benchmark the throughput and the output against the spacy pipeline (python tokenizer.py [plain text files]).
+"""
+
+# packages and modules
+import logging, sys, re, timeit
+from helper_functions import *
+
+
+class FastTokenizer():
+
+	def __init__(self, stop_words, lemma_lookup = None):
+
+		"""
+			Parameters
+			----------
+			stop_words : set
+				words to remove (see preprocessing.get_stop_words)
+			lemma_lookup : dictionary (optional)
+				lemma of each word form. Default is the lookup table of spacy (see load_lemma_lookup)
+		"""
+
+		# alphabetic words only, which excludes numbers and punctuation (similar to token.is_alpha)
+		self.word_pattern = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+		self.stop_words = stop_words
+		self.lemma_lookup = lemma_lookup if lemma_lookup is not None else load_lemma_lookup()
+
+		# lemma of each word seen so far
+		self.lemmas = {}
+
+	def lemmatize(self, word):
+
+		"""
+			Return the lemma of a word; words that are not in the lookup table are lowercased
+		"""
+
+		lemma = self.lemmas.get(word)
+
+		if lemma is None:
+			lemma = self.lemma_lookup.get(word) or self.lemma_lookup.get(word.lower()) or word.lower()
+			self.lemmas[word] = lemma
+
+		return lemma
+
+	def tokenize(self, content, min_bigram_count = 5):
+
+		"""
+			Tokenize the content of a document
+
+			Parameters
+			----------
+			content : string
+				content of the document
+			min_bigram_count : int (optional)
+				frequency of bigram to occur to include into list of bigrams. None for no bigrams
+
+			Returns
+			-------
+			fields : dictionary
+				tokens (unigrams and bigrams), and the number of unigrams and entities (always 0), like preprocessing.get_tokens
+		"""
+
+		# tokenize, remove stop words and single character words, lemmatize
+		unigrams = [self.lemmatize(word) for word in self.word_pattern.findall(content) if len(word) > 1 and word not in self.stop_words and word.lower() not in self.stop_words]
+
+		# get bigrams
+		bigrams = get_document_bigrams(unigrams, min_bigram_count) if min_bigram_count is not None else []
+
+		return {'tokens' : unigrams + bigrams, 'num_unigrams' : len(unigrams), 'num_entities' : 0}
+
+
+"""
+
+internal helper functions
+
+"""
+
+def load_lemma_lookup():
+
+	"""
+		Load the lemma lookup table of spacy. Older versions of spacy ship the table with the English language data, newer versions
+		in the spacy-lookups-data package. Returns an empty table (words are only lowercased) if neither is available
+	"""
+
+	try:
+		from spacy.lang.en.lemmatizer import LOOKUP
+		return LOOKUP
+	except ImportError:
+		pass
+
+	try:
+		from spacy.lookups import load_lookups
+		return load_lookups('en', ['lemma_lookup']).get_table('lemma_lookup')
+	except Exception, e:
+		logging.warning('[{}] : no lemma lookup table available, words will only be lowercased: {}'.format(sys._getframe().f_code.co_name,e))
+		return {}
+
+
+def benchmark(documents, min_bigram_count = 5):
+
+	"""
+		Compare the throughput and the output of the FastTokenizer with the spacy pipeline of general_preprocessing
+
+		Parameters
+		----------
+		documents : list of unicode
+			plain text documents, e.g. abstracts
+		min_bigram_count : int (optional)
+			frequency of bigram to occur to include into list of bigrams
+
+		Returns
+		-------
+		spacy_time : float
+			seconds per document of the spacy pipeline
+		fast_time : float
+			seconds per document of the FastTokenizer
+		overlap : float
+			mean Jaccard similarity between the unigrams of both tokenizers
+	"""
+
+	# imported here, since preprocessing imports this module
+	from preprocessing import setup_spacy, get_stop_words, get_tokens
+
+	nlp = setup_spacy(disable = ['parser'])
+	fast_tokenizer = FastTokenizer(get_stop_words())
+
+	start = timeit.default_timer()
+	spacy_tokens = [get_tokens(content, min_bigram_count) for content in nlp.pipe(documents)]
+	spacy_time = (timeit.default_timer() - start) / len(documents)
+
+	start = timeit.default_timer()
+	fast_tokens = [fast_tokenizer.tokenize(content, min_bigram_count) for content in documents]
+	fast_time = (timeit.default_timer() - start) / len(documents)
+
+	# similarity of the unigrams of each document
+	overlap = []
+	for s, f in zip(spacy_tokens, fast_tokens):
+		s, f = set(s['tokens'][:s['num_unigrams']]), set(f['tokens'][:f['num_unigrams']])
+		overlap.append(float(len(s & f)) / max(len(s | f), 1))
+
+	return spacy_time, fast_time, sum(overlap) / max(len(overlap), 1)
+
+
+if __name__ == "__main__":
+
+	# plain text documents from the command line, or the first 1000 documents from the database
+	if len(sys.argv) > 1:
+		documents = [open(f, 'rb').read().decode('utf8') for f in sys.argv[1:]]
+	else:
+		from database import MongoDatabase
+		documents = [d['content'] for d in MongoDatabase().read_collection(collection = 'publications_raw', projection = {'content' : 1}).limit(1000)]
+
+	spacy_time, fast_time, overlap = benchmark(documents)
+
+	print 'spacy pipeline : {:.2f} ms per document'.format(spacy_time * 1000)
+	print 'FastTokenizer  : {:.2f} ms per document'.format(fast_time * 1000)
+	print 'speedup        : {:.1f}x'.format(spacy_time / fast_time)
+	print 'unigram overlap: {:.1%}'.format(overlap)
@@ -28,10 +28,16 @@
 
 # packages and modules
 import logging, sys, re
-from gensim import corpora
+import multiprocessing, copy
+from gensim import corpora, matutils, utils
 from database import MongoDatabase
+from binary_corpus import BinaryCorpus
+from hash_dictionary import HashedDictionary
 from helper_functions import *
 
+# database connection and vocabulary of packed tokens of a worker process (see count_shard)
+DB = None
+ID2TOKEN = None
 
 class Transformation():
 
@@ -42,7 +48,9 @@ class Transformation():
 		# instantiate database
 		self.db = MongoDatabase()
 
-	def transform_for_lda(self, save_folder = os.path.join('files', 'lda'), no_below = 5, no_above = 0.90):
+	def transform_for_lda(self, save_folder = os.path.join('files', 'lda'), no_below = 5, no_above = 0.90, streaming = False, token_file = None, 
+							n_workers = None, shard_size = 10000, corpus_format = 'mm', append = False, num_buckets = None, top_k = 3, 
+							max_drift = None):
 
 		"""
 			Transform the corpus of words into LDA input features
@@ -57,27 +65,681 @@ class Transformation():
 				Keep tokens which are contained in at least no_below documents.
 			no_above: (float, optional)
 				Keep tokens which are contained in no more than no_above documents (fraction of total corpus size, not an absolute number).
+			streaming: (bool, optional)
+				Stream the tokens twice (once for the dictionary, once for the corpus) instead of keeping the tokens and the corpus of all documents 
+				in memory. Memory use is then bounded by the size of the dictionary instead of the size of the corpus.
+			token_file: (os.path, optional)
+				Only used when streaming. Side file the tokens are written to during the first pass, so the second pass reads the tokens from a local 
+				file instead of the database. Default is None (both passes read from the database).
+			n_workers: (int, optional)
+				Build the dictionary in parallel: shards of the collection are counted by n_workers processes and merged. The token ids are assigned 
+				in sorted order of the tokens, so the dictionary is the same for any number of workers. The tokens are then only needed once more, for
+				the corpus, and are always streamed (streaming is implied), so they are not kept in memory. Default is None (dictionary is built by 
+				this process, with token ids in order of first occurrence).
+			shard_size: (int, optional)
+				Number of documents per shard when the dictionary is built in parallel.
+			corpus_format: (string, optional)
+				'mm' to save the corpus as a MatrixMarket file (corpus.mm), or 'binary' to save the corpus as a binary corpus (corpus.csr) that is opened
+				memory-mapped by get_dic_corpus, see binary_corpus.py.
+			append: (bool, optional)
+				Only add the documents that were tokenized since the last build to the dictionary and corpus (see append_for_lda). Falls back to a 
+				full build if there is no earlier build with the same settings, or if more tokens crossed the thresholds than max_drift allows; the 
+				prunes of the earlier build (see prune_corpus) are then applied again to the full build.
+			num_buckets: (int, optional)
+				Hash the tokens into num_buckets buckets with a HashedDictionary (see hash_dictionary.py), so memory does not grow with the size of the
+				vocabulary. Tokens in the same bucket share a token id. Default is None (gensim Dictionary with one id per token).
+			top_k: (int, optional)
+				Number of most frequent surface forms kept per bucket, used to label the token ids of a HashedDictionary.
+			max_drift: (float, optional)
+				Only used with append. Fraction of the kept vocabulary that may cross the thresholds since the last build before the append falls back 
+				to a full build, see append_for_lda. Default is None (the vocabulary of the build is kept until the next full build).
 
 		"""
 
-		# read document collection
-		D = self.db.read_collection(collection = 'publications_raw')
+		# try to append the new documents to the dictionary and corpus of the last build
+		if append and self.append_for_lda(save_folder, no_below, no_above, corpus_format, num_buckets, max_drift):
+			return
+
+		# prunes of the last build, which are applied again if this build replaces an append
+		build_info = load_build_info(save_folder) if append else None
+		prunes = build_info.get('prunes', []) if build_info is not None else []
+
+		# vocabulary of packed tokens
+		id2token = load_token_vocabulary()
+
+		# documents that were tokenized before tokens_seq was recorded belong to every build
+		self.db.update_many_in_collection(collection = 'publications_raw', query = {'$and' : [get_tokenized_query(), {'tokens_seq' : {'$exists' : False}}]}, 
+											fields = {'tokens_seq' : 0})
+		self.db.create_index(collection = 'publications_raw', keys = ['tokens_seq'])
+
+		# the build contains the documents that were first tokenized up to the watermark, so both passes read the same documents; documents that are 
+		# tokenized later get a higher tokens_seq and can be appended
+		watermark = self.db.get_sequence('publications_raw.tokens_seq')
+		query = {'tokens_seq' : {'$lte' : watermark}}
+
+		# the sharded dictionary is counted by the workers, so this process only needs the tokens for the corpus and streams them
+		if n_workers is not None and num_buckets is None:
+			streaming = True
 
 		# create word input features per document
-		texts = [x['tokens'] for x in D]
+		if streaming:
+			texts = TokenStream(self.db, id2token, token_file, query)
+		else:
+			# read the tokens of the document collection
+			D = self.db.read_collection(collection = 'publications_raw', query = query, projection = {'tokens' : 1, 'packed_tokens' : 1})
+			texts, ids = [], []
+			for d in D:
+				texts.append(get_document_tokens(d, id2token))
+				ids.append(d['_id'])
 
-		# create dictionary of docs and filter away to % and bottom frequency
-		dictionary = corpora.Dictionary(texts)
-		dictionary.filter_extremes(no_below = no_below, no_above = no_above)
+		# create dictionary of docs, either hashed, in this process or from shards counted in parallel
+		if num_buckets is not None:
+			dictionary = HashedDictionary(texts, num_buckets = num_buckets, top_k = top_k)
+		elif n_workers is not None:
+			dictionary = self.build_sharded_dictionary(n_workers, shard_size, query)
+		else:
+			dictionary = corpora.Dictionary(texts)
 
 		# create save folder if not exists
 		create_directory(save_folder)
 
+		# store the dictionary before filtering, so new documents can be appended to it
+		dictionary.save(os.path.join(save_folder, 'dictionary_full.dict'))
+
+		# the no_above threshold as a number of documents, which appends keep fixed
+		max_df = int(no_above * dictionary.num_docs)
+
+		# filter away to % and bottom frequency
+		dictionary.filter_extremes(no_below = no_below, no_above = no_above)
+
+		if num_buckets is not None:
+			logging.info('Hashed dictionary collision statistics: {}'.format(dictionary.collision_stats()))
+
 		# store the dictionary, for future reference
 		dictionary.save(os.path.join(save_folder, 'dictionary.dict'))
 		
-		# create vector based corpus => bag of words with frequencies stored as a sparsed vector
-		corpus = [dictionary.doc2bow(text) for text in texts]
+		# create vector based corpus => bag of words with frequencies stored as a sparsed vector; when streaming, the vectors are created while they are written
+		corpus = (dictionary.doc2bow(text) for text in texts) if streaming else [dictionary.doc2bow(text) for text in texts]
 		
 		# store to disk, for later use
-		corpora.MmCorpus.serialize(os.path.join(save_folder, 'corpus.mm'), corpus)
+		save_corpus(save_folder, corpus, dictionary, corpus_format)
+
+		# record the documents in the corpus and the settings of the build
+		save_corpus_ids(save_folder, texts.ids if streaming else ids)
+		save_build_info(save_folder, {'watermark' : watermark, 'no_below' : no_below, 'no_above' : no_above, 'max_df' : max_df, 'drift' : 0, 
+										'corpus_format' : corpus_format, 'num_buckets' : num_buckets, 'prunes' : []})
+
+		# apply the prunes of the build that is replaced
+		for prune in prunes:
+			self.prune_corpus(save_folder, **prune)
+
+	def append_for_lda(self, save_folder = os.path.join('files', 'lda'), no_below = 5, no_above = 0.90, corpus_format = 'mm', num_buckets = None, 
+						max_drift = None):
+
+		"""
+			Append the documents that were tokenized since the last build to the dictionary and corpus. Every batch of tokens written by the preprocessing
+			phase gets a number from a sequence that is incremented by the database server, and each document keeps the number of the batch in which it 
+			was first tokenized (tokens_seq). The build records the last number of the sequence as its watermark, so the new documents are found with an 
+			indexed range query, and the cost of an append depends on the number of new documents, not on the size of the corpus. ObjectIds can not be 
+			used as a watermark, since they are created by the clients and documents do not arrive in order of _id. Batches that are still being written 
+			while the build reads the collection can be missed, so do not run a build or append during the preprocessing phase.
+
+			The vocabulary of the build is kept: the new documents are converted with the dictionary of the build (pruned, if prune_corpus was used), and 
+			their bag-of-words are appended to the serialized corpus in place. The document frequencies of the unfiltered dictionary are updated, and the 
+			number of tokens that cross the thresholds (drift) is counted with the no_above threshold fixed at its number of documents at build time, so
+			it does not move with the number of documents. Tokens that cross a threshold only enter or leave the vocabulary with the next full build, 
+			which happens when the drift exceeds max_drift, or when transform_for_lda is run without append. Documents of which the tokens changed after 
+			they were added to the corpus are not updated; run a full build for those.
+
+			Parameters
+			----------
+			save_folder: os.path
+				location of the dictionary and corpus of the last build
+			no_below:	(int, optional)
+				Keep tokens which are contained in at least no_below documents.
+			no_above: (float, optional)
+				Keep tokens which are contained in no more than no_above documents (fraction of total corpus size, not an absolute number).
+			corpus_format: (string, optional)
+				'mm' or 'binary', see transform_for_lda
+			num_buckets: (int, optional)
+				number of buckets of a HashedDictionary, or None for a gensim Dictionary, see transform_for_lda
+			max_drift: (float, optional)
+				fraction of the kept vocabulary that may cross the thresholds since the last build; None to keep the vocabulary until the next full build
+
+			Returns
+			-------
+			appended : bool
+				False if a full build is needed: there is no earlier build with the same settings, or the drift exceeds max_drift
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# settings of the last build
+		build_info = load_build_info(save_folder)
+		if build_info is None or 'watermark' not in build_info or [build_info['no_below'], build_info['no_above'], build_info['corpus_format'], 
+									build_info.get('num_buckets')] != [no_below, no_above, corpus_format, num_buckets]:
+			logging.info('No earlier build with the same settings, a full build is needed')
+			return False
+
+		# read the tokens of the documents that were first tokenized after the last build or append
+		watermark = self.db.get_sequence('publications_raw.tokens_seq')
+		D = self.db.read_collection(collection = 'publications_raw', query = {'tokens_seq' : {'$gt' : build_info['watermark'], '$lte' : watermark}}, 
+									projection = {'tokens' : 1, 'packed_tokens' : 1})
+
+		# vocabulary of packed tokens
+		id2token = load_token_vocabulary()
+
+		texts, ids = [], []
+		for d in D:
+			texts.append(get_document_tokens(d, id2token))
+			ids.append(d['_id'])
+
+		if len(texts) == 0:
+			logging.info('No new documents since the last build')
+			return True
+
+		# update the document frequencies of the unfiltered dictionary, and count the tokens that cross the thresholds
+		full_dictionary = corpora.Dictionary.load(os.path.join(save_folder, 'dictionary_full.dict'))
+		kept_vocabulary = get_kept_vocabulary(filter_dictionary(full_dictionary, no_below, build_info['max_df']))
+		full_dictionary.add_documents(texts, prune_at = None)
+		drift = build_info['drift'] + len(kept_vocabulary ^ get_kept_vocabulary(filter_dictionary(full_dictionary, no_below, build_info['max_df'])))
+
+		# the vocabulary of the build, with its token ids
+		dictionary = corpora.Dictionary.load(os.path.join(save_folder, 'dictionary.dict'))
+
+		if max_drift is not None and drift > max_drift * len(dictionary):
+			logging.info('{} tokens crossed the thresholds since the last build, a full build is needed'.format(drift))
+			return False
+
+		# add the bag-of-words of the new documents to the end of the corpus
+		append_corpus(save_folder, (dictionary.doc2bow(text) for text in texts), dictionary, corpus_format)
+
+		# store the updated unfiltered dictionary, the documents in the corpus and the new watermark
+		full_dictionary.save(os.path.join(save_folder, 'dictionary_full.dict'))
+		save_corpus_ids(save_folder, ids, append = True)
+		build_info.update(watermark = watermark, drift = drift)
+		save_build_info(save_folder, build_info)
+
+		logging.info('Appended {} documents to the corpus, {} tokens crossed the thresholds since the last build'.format(len(texts), drift))
+
+		return True
+
+	def prune_corpus(self, save_folder = os.path.join('files', 'lda'), no_below = None, no_above = None, tfidf_quantile = None, stop_words = None):
+
+		"""
+			Prune the dictionary and corpus of the last build within a sparse matrix representation, without reading the tokens from the database again. 
+			The corpus is loaded as a sparse documents x tokens matrix, and the document frequencies and TF-IDF scores of all tokens are computed with 
+			vectorized operations on the matrix. Tokens are removed if they are outside the document frequency thresholds, if their TF-IDF score is 
+			below a quantile of the scores, or if they are in the stop list. The dictionary is renumbered and the pruned corpus is saved in the same 
+			format, replacing the dictionary and corpus. The prune is recorded with the build, so append_for_lda keeps it, and a full build that replaces 
+			an append applies it again.
+
+			Parameters
+			----------
+			save_folder: os.path
+				location of the dictionary and corpus
+			no_below: (int, optional)
+				Keep tokens which are contained in at least no_below documents.
+			no_above: (float, optional)
+				Keep tokens which are contained in no more than no_above documents (fraction of total corpus size, not an absolute number).
+			tfidf_quantile: (float, optional)
+				Remove the tokens with a TF-IDF score below this quantile of the scores, e.g. 0.05 removes the 5% least informative tokens. The score of 
+				a token is its maximum TF-IDF in any document, with the term frequency relative to the length of the document.
+			stop_words: (list, optional)
+				Tokens to remove, e.g. domain-specific stop words found in the evaluation phase.
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# read dictionary and corpus
+		dictionary, corpus = get_dic_corpus(save_folder)
+		corpus_format = 'binary' if isinstance(corpus, BinaryCorpus) else 'mm'
+
+		# documents x tokens matrix, with the tokens as columns
+		X = matutils.corpus2csc(corpus, num_terms = len(dictionary), dtype = np.float64).T.tocsc()
+		num_docs, num_terms = X.shape
+
+		# document frequency of each token: the number of stored values in its column
+		dfs = np.diff(X.indptr)
+
+		keep = np.ones(num_terms, dtype = bool)
+
+		# document frequency thresholds
+		if no_below is not None:
+			keep &= dfs >= no_below
+		if no_above is not None:
+			keep &= dfs <= int(no_above * num_docs)
+
+		logging.info('Document frequency thresholds keep {} of {} tokens'.format(keep.sum(), num_terms))
+
+		# TF-IDF score of each token: the maximum over the documents of the relative term frequency times the inverse document frequency
+		if tfidf_quantile is not None:
+
+			doc_lengths = np.asarray(X.sum(axis = 1)).ravel()
+			idf = np.log(float(num_docs) / np.maximum(dfs, 1))
+
+			tfidf = X.copy()
+			tfidf.data = tfidf.data / doc_lengths[tfidf.indices] * np.repeat(idf, dfs)
+			scores = np.asarray(tfidf.max(axis = 0).todense()).ravel()
+
+			# a corpus without any tokens has no scores to take a quantile of
+			if dfs.any():
+				keep &= scores >= np.percentile(scores[dfs > 0], tfidf_quantile * 100)
+
+			logging.info('TF-IDF quantile {} keeps {} tokens'.format(tfidf_quantile, keep.sum()))
+
+		# custom stop list
+		if stop_words is not None:
+			# looked up with doc2bow, which finds the bucket of any token of a HashedDictionary, not only of the surface forms in token2id
+			stop_ids = [token_id for token_id, _ in dictionary.doc2bow(stop_words)]
+			keep[stop_ids] = False
+
+			logging.info('Stop list removes {} tokens, {} tokens left'.format(len(stop_ids), keep.sum()))
+
+		# renumber the dictionary; the new ids follow the order of the old ids, like the columns of the pruned matrix
+		good_ids = np.where(keep)[0]
+		dictionary.filter_tokens(good_ids = good_ids.tolist())
+
+		# pruned documents x tokens matrix, one row per document
+		X = X[:, good_ids].tocsr()
+
+		# save the pruned dictionary and corpus
+		dictionary.save(os.path.join(save_folder, 'dictionary.dict'))
+		save_corpus(save_folder, ([(int(i), int(c)) for i, c in itertools.izip(X.indices[X.indptr[d]:X.indptr[d + 1]], X.data[X.indptr[d]:X.indptr[d + 1]])] 
+									for d in xrange(num_docs)), dictionary, corpus_format)
+
+		# record the prune with the build
+		build_info = load_build_info(save_folder)
+		if build_info is not None:
+			build_info['prunes'] = build_info.get('prunes', []) + [{'no_below' : no_below, 'no_above' : no_above, 'tfidf_quantile' : tfidf_quantile, 
+																	'stop_words' : stop_words}]
+			save_build_info(save_folder, build_info)
+
+		logging.info('Pruned corpus: {} documents, {} of {} tokens kept, {} non-zeros'.format(num_docs, len(good_ids), num_terms, X.nnz))
+
+	def threshold_sweep(self, save_folder = os.path.join('files', 'lda'), no_below = [1, 2, 5, 10, 20, 50, 100], no_above = [0.5, 0.7, 0.9, 1.0], 
+						keep_n = 100000, table_folder = os.path.join('files', 'tables')):
+
+		"""
+			Compute the effect of a grid of no_below and no_above thresholds on the vocabulary and corpus, without building the dictionary for each of them.
+			For each combination the table contains the vocabulary size, the number of non-zeros of the corpus (the number of document-token pairs, 
+			which drives the time and memory of the inference) and the coverage (fraction of all token occurrences that are kept).
+
+			The document frequencies and collection frequencies are read once from the unfiltered dictionary of the last build (dictionary_full.dict), 
+			or counted in one pass over the tokens if there is no build yet. The tokens are sorted by document frequency, so the tokens kept by a pair 
+			of thresholds are a contiguous range, and its totals follow from cumulative sums.
+
+			Parameters
+			----------
+			save_folder: os.path
+				location of the unfiltered dictionary of the last build
+			no_below: (list of int, optional)
+				values of no_below to evaluate
+			no_above: (list of float, optional)
+				values of no_above to evaluate
+			keep_n: (int, optional)
+				maximum number of tokens kept, as in filter_extremes (which transform_for_lda calls with its default of 100000). None for no maximum
+			table_folder: os.path
+				location to save the table (threshold-sweep.csv) to
+
+			Returns
+			-------
+			table : list of lists
+				header and one row per combination of thresholds
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# unfiltered dictionary of the last build, or count the tokens in one pass
+		if os.path.exists(os.path.join(save_folder, 'dictionary_full.dict')):
+			dictionary = corpora.Dictionary.load(os.path.join(save_folder, 'dictionary_full.dict'))
+		else:
+			dictionary = corpora.Dictionary(TokenStream(self.db, load_token_vocabulary()))
+
+		# document frequency and collection frequency of each token, sorted by document frequency
+		dfs, cfs = get_token_frequencies(dictionary)
+		order = np.argsort(dfs, kind = 'mergesort')
+		dfs, cfs = dfs[order], cfs[order] if cfs is not None else None
+
+		cumulative_dfs = np.concatenate([[0], np.cumsum(dfs)])
+		cumulative_cfs = np.concatenate([[0], np.cumsum(cfs)]) if cfs is not None else None
+
+		table = [['no_below', 'no_above', 'keep_n', 'vocabulary', 'nonzeros', 'coverage']]
+		for below in no_below:
+			for above in no_above:
+
+				# range of the tokens within the thresholds; keep_n keeps the tokens with the highest document frequency
+				start = np.searchsorted(dfs, below, side = 'left')
+				end = max(start, np.searchsorted(dfs, int(above * dictionary.num_docs), side = 'right'))
+				if keep_n is not None:
+					start = max(start, end - keep_n)
+
+				coverage = float(cumulative_cfs[end] - cumulative_cfs[start]) / max(cumulative_cfs[-1], 1) if cfs is not None else ''
+
+				table.append([below, above, keep_n, end - start, cumulative_dfs[end] - cumulative_dfs[start], coverage])
+
+		logging.info('Computed {} threshold combinations for {} documents and {} unique tokens'.format(len(table) - 1, dictionary.num_docs, len(dfs)))
+
+		# save to CSV
+		save_csv(table, 'threshold-sweep', folder = table_folder)
+
+		return table
+
+	def build_sharded_dictionary(self, n_workers = 4, shard_size = 10000, query = None):
+
+		"""
+			Build the dictionary of the collection in parallel. The collection is divided into shards of consecutive _ids, the document frequency and 
+			collection frequency of the tokens in each shard are counted by a pool of processes, and the counts are merged. Token ids are assigned in 
+			sorted order of the tokens, and the counts are summed, so the result does not depend on the number of workers or the order in which the 
+			shards finish.
+
+			Parameters
+			----------
+			n_workers : int (optional)
+				number of processes that count shards
+			shard_size : int (optional)
+				number of documents per shard
+			query : dictionary (optional)
+				only count the documents that match the query
+
+			Returns
+			-------
+			dictionary : corpora.Dictionary
+				dictionary of all tokens, not filtered yet
+		"""
+
+		logging.info('Start {}'.format(sys._getframe().f_code.co_name))
+
+		# boundaries of the shards: every shard_size-th _id in sorted order
+		ids = self.db.read_collection(collection = 'publications_raw', query = query, projection = {'_id' : 1}).sort('_id', 1)
+		boundaries = [d['_id'] for i, d in enumerate(ids) if i % shard_size == 0]
+		shards = [(start, end, query) for start, end in zip(boundaries, boundaries[1:] + [None])]
+
+		# count the shards in parallel; each worker opens its own database connection
+		pool = multiprocessing.Pool(n_workers)
+
+		dfs, cfs, num_docs, num_pos, num_nnz = Counter(), Counter(), 0, 0, 0
+		for shard_dfs, shard_cfs, shard_docs, shard_pos, shard_nnz in pool.imap_unordered(count_shard, shards):
+			dfs.update(shard_dfs)
+			cfs.update(shard_cfs)
+			num_docs += shard_docs
+			num_pos += shard_pos
+			num_nnz += shard_nnz
+
+		pool.close()
+		pool.join()
+
+		# assign token ids in sorted order of the tokens
+		dictionary = corpora.Dictionary()
+		dictionary.token2id = {token : i for i, token in enumerate(sorted(dfs))}
+		dictionary.dfs = {dictionary.token2id[token] : df for token, df in dfs.iteritems()}
+		dictionary.cfs = {dictionary.token2id[token] : cf for token, cf in cfs.iteritems()}
+		dictionary.num_docs, dictionary.num_pos, dictionary.num_nnz = num_docs, num_pos, num_nnz
+
+		logging.info('Merged {} shards: {} documents, {} unique tokens'.format(len(shards), num_docs, len(dictionary.token2id)))
+
+		return dictionary
+
+
+"""
+
+internal helper functions
+
+"""
+
+def count_shard(shard):
+
+	"""
+		Count the document frequency and collection frequency of the tokens in a shard of the collection. Used by the parallel dictionary build, so it
+		needs to be a module-level function
+
+		Parameters
+		----------
+		shard : tuple
+			first _id of the shard, first _id of the next shard (None for the last shard) and the query of the documents to count (None for all)
+
+		Returns
+		-------
+		counts : tuple
+			document frequency and collection frequency of each token, and the number of documents, tokens and unique tokens per document in the shard
+	"""
+
+	# database connection and vocabulary are created once per process
+	global DB, ID2TOKEN
+	if DB is None:
+		DB = MongoDatabase()
+		ID2TOKEN = load_token_vocabulary()
+
+	start, end, query = shard
+	query = {'$and' : [query or {}, {'_id' : {'$gte' : start, '$lt' : end} if end is not None else {'$gte' : start}}]}
+
+	dfs, cfs, num_docs, num_pos, num_nnz = Counter(), Counter(), 0, 0, 0
+	for d in DB.read_collection(collection = 'publications_raw', query = query, projection = {'tokens' : 1, 'packed_tokens' : 1}):
+
+		counts = Counter(get_document_tokens(d, ID2TOKEN))
+
+		dfs.update(counts.iterkeys())
+		cfs.update(counts)
+		num_docs += 1
+		num_pos += sum(counts.itervalues())
+		num_nnz += len(counts)
+
+	return dfs, cfs, num_docs, num_pos, num_nnz
+
+
+def get_tokenized_query():
+
+	"""
+		Return the query of the documents that have been tokenized, either as plain tokens or as packed tokens
+	"""
+
+	return {'$or' : [{'tokens' : {'$exists' : True}}, {'packed_tokens' : {'$exists' : True}}]}
+
+def save_build_info(save_folder, build_info):
+
+	"""
+		Save the information of a build of the dictionary and corpus: the watermark (last tokens_seq in the corpus), the settings of the build, the 
+		no_above threshold as a number of documents (max_df), the number of tokens that crossed the thresholds since the build (drift), and the 
+		settings of the prunes applied to it after the build (see prune_corpus)
+	"""
+
+	with open(os.path.join(save_folder, 'build.json'), 'wb') as f:
+		json.dump(dict(build_info, timestamp = datetime.now().isoformat()), f)
+
+def save_corpus_ids(save_folder, ids, append = False):
+
+	"""
+		Save the _ids of the documents in the corpus, one per line in the order of the rows of the corpus (corpus_ids.txt), or append the _ids of 
+		appended documents. A new file is written to a temporary file first, so it is replaced at once
+	"""
+
+	ids_file = os.path.join(save_folder, 'corpus_ids.txt')
+	with open(ids_file if append else ids_file + '.tmp', 'ab' if append else 'wb') as f:
+		for _id in ids:
+			f.write(str(_id) + '\n')
+	if not append:
+		os.rename(ids_file + '.tmp', ids_file)
+
+def save_corpus(save_folder, corpus, dictionary, corpus_format = 'mm'):
+
+	"""
+		Save a corpus as a MatrixMarket file (corpus.mm) or as a binary corpus (corpus.csr). The corpus is written to a temporary file first, so it may 
+		be streamed from the corpus that it replaces
+	"""
+
+	if corpus_format == 'binary':
+		BinaryCorpus.serialize(os.path.join(save_folder, 'corpus.csr'), corpus)
+	else:
+		corpus_file = os.path.join(save_folder, 'corpus.mm')
+		corpora.MmCorpus.serialize(corpus_file + '.tmp', corpus, id2word = dictionary)
+		os.rename(corpus_file + '.tmp', corpus_file)
+		if os.path.exists(corpus_file + '.tmp.index'):
+			os.rename(corpus_file + '.tmp.index', corpus_file + '.index')
+
+def append_corpus(save_folder, corpus, dictionary, corpus_format = 'mm'):
+
+	"""
+		Append documents to a saved corpus in place (see BinaryCorpus.append and append_mm_corpus). A MatrixMarket corpus with a header that has no 
+		room for the new sizes is written again
+	"""
+
+	if corpus_format == 'binary':
+		BinaryCorpus.append(os.path.join(save_folder, 'corpus.csr'), corpus)
+	else:
+		corpus = list(corpus)
+		if not append_mm_corpus(os.path.join(save_folder, 'corpus.mm'), corpus):
+			old_corpus = corpora.MmCorpus(os.path.join(save_folder, 'corpus.mm'))
+			save_corpus(save_folder, itertools.chain(old_corpus, corpus), dictionary, corpus_format)
+
+def append_mm_corpus(corpus_file, corpus):
+
+	"""
+		Append documents to a MatrixMarket corpus in place: the entries of the new documents are written after the existing entries, their offsets are
+		added to the index (corpus.mm.index), and the sizes in the header are written again. gensim pads the line with the sizes to 50 characters, so 
+		the new sizes fit in place
+
+		Returns
+		-------
+		appended : bool
+			False if the sizes line has no room for the new sizes, and nothing was written
+	"""
+
+	with open(corpus_file, 'r+b') as f:
+
+		# header line, then the line with the number of documents, terms and non-zeros
+		f.readline()
+		sizes_offset = f.tell()
+		sizes_line = f.readline()
+		num_docs, num_terms, num_nnz = [int(x) for x in sizes_line.split()]
+
+		new_docs = len(corpus)
+		new_terms = max([num_terms] + [token_id + 1 for bow in corpus for token_id, _ in bow])
+		new_nnz = num_nnz + sum(len(bow) for bow in corpus)
+
+		sizes = '{} {} {}'.format(num_docs + new_docs, new_terms, new_nnz)
+		if len(sizes) > len(sizes_line.rstrip('\n')):
+			return False
+
+		# offset of each document, or -1 for a document without entries, like the index written by gensim
+		offsets = list(utils.unpickle(corpus_file + '.index'))
+
+		f.seek(0, os.SEEK_END)
+		for docno, bow in enumerate(corpus, start = num_docs):
+			position = f.tell()
+			if len(offsets) > 0 and offsets[-1] == position:
+				offsets[-1] = -1
+			offsets.append(position)
+			for token_id, count in bow:
+				f.write('{} {} {}\n'.format(docno + 1, token_id + 1, count))
+
+		# the sizes are written last
+		utils.pickle(offsets, corpus_file + '.index')
+		f.seek(sizes_offset)
+		f.write(sizes.ljust(len(sizes_line.rstrip('\n'))))
+
+	return True
+
+def filter_dictionary(dictionary, no_below, max_df):
+
+	"""
+		Return a filtered copy of a dictionary, with the no_above threshold given as a number of documents (max_df)
+	"""
+
+	dictionary = copy.deepcopy(dictionary)
+	dictionary.filter_extremes(no_below = no_below, no_above = (max_df + 0.5) / max(dictionary.num_docs, 1))
+
+	return dictionary
+
+def get_token_frequencies(dictionary):
+
+	"""
+		Return the document frequency and collection frequency of each token of a gensim Dictionary, or of each bucket with at least one token of a 
+		HashedDictionary. The collection frequencies are None for gensim versions that do not count them
+	"""
+
+	if isinstance(dictionary, HashedDictionary):
+		dfs, cfs = dictionary.bucket_dfs[dictionary.id2bucket], dictionary.bucket_cfs[dictionary.id2bucket]
+		return dfs[dfs > 0], cfs[dfs > 0]
+
+	token_ids = sorted(dictionary.dfs)
+	dfs = np.array([dictionary.dfs[i] for i in token_ids], dtype = np.int64)
+	cfs = np.array([dictionary.cfs.get(i, 0) for i in token_ids], dtype = np.int64) if hasattr(dictionary, 'cfs') else None
+
+	return dfs, cfs
+
+def get_kept_vocabulary(dictionary):
+
+	"""
+		Return the kept vocabulary of a filtered dictionary as a set: the tokens of a gensim Dictionary, or the kept buckets of a HashedDictionary
+	"""
+
+	return set(dictionary.id2bucket.tolist()) if isinstance(dictionary, HashedDictionary) else set(dictionary.token2id)
+
+def load_build_info(save_folder):
+
+	"""
+		Load the information of the last build (see save_build_info), or None if there is no build with an unfiltered dictionary and the _ids of the 
+		documents in the corpus
+	"""
+
+	for file in ['build.json', 'dictionary_full.dict', 'corpus_ids.txt']:
+		if not os.path.exists(os.path.join(save_folder, file)):
+			return None
+
+	with open(os.path.join(save_folder, 'build.json'), 'rb') as f:
+		return json.load(f)
+
+
+"""
+
+internal helper class
+
+"""
+
+class TokenStream():
+
+	"""
+		Re-iterable stream of the tokens of each document in the collection, for building the dictionary and corpus without keeping all tokens in memory.
+		Each iteration reads the tokens of the documents that match the query from the database with a projected cursor, in the natural order of the 
+		collection. If a token file is given, the first full iteration also writes the tokens to it (one JSON list per line), and later iterations read 
+		the token file instead. The _ids of the documents of the last iteration over the database are kept in ids, in order
+	"""
+
+	def __init__(self, db, id2token, token_file = None, query = None):
+
+		self.db = db
+		self.id2token = id2token
+		self.token_file = token_file
+		self.query = query
+		self.ids = []
+
+		# remove the token file of an earlier run, since the tokens in the database may have changed
+		if token_file is not None and os.path.exists(token_file):
+			os.remove(token_file)
+
+	def __iter__(self):
+
+		# read the tokens from the side file of a previous iteration
+		if self.token_file is not None and os.path.exists(self.token_file):
+			with open(self.token_file, 'rb') as f:
+				for line in f:
+					yield json.loads(line)
+			return
+
+		D = self.db.read_collection(collection = 'publications_raw', query = self.query, projection = {'tokens' : 1, 'packed_tokens' : 1})
+		self.ids = []
+
+		if self.token_file is None:
+			for d in D:
+				self.ids.append(d['_id'])
+				yield get_document_tokens(d, self.id2token)
+			return
+
+		# write the tokens to a temporary file, which only becomes the side file after a complete iteration
+		with open(self.token_file + '.tmp', 'wb') as f:
+			for d in D:
+				self.ids.append(d['_id'])
+				tokens = get_document_tokens(d, self.id2token)
+				f.write(json.dumps(tokens) + '\n')
+				yield tokens
+		os.rename(self.token_file + '.tmp', self.token_file)